@@ -615,7 +615,7 @@ def train_one_epoch(opt, model, train_dataset, optimizer, warmup=False):
                 
         epoch_cost += cost.detach().cpu().numpy() 
 
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         cost.backward()
         optimizer.step()   
                 
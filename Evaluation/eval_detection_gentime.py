@@ -1,10 +1,48 @@
-import json
+from dataclasses import dataclass, fields
+from typing import Optional
+
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 from utils import get_blocked_videos
 from utils import interpolated_prec_rec
-from utils import segment_iou
+from utils import load_json
+from utils import wrapper_segment_iou
+
+
+@dataclass
+class Segments:
+    """Temporal segments stored as parallel arrays, one entry per instance.
+    video_id holds integer video codes once the segments are encoded, and
+    score and gentime are only set for predictions.
+    """
+    video_id: np.ndarray
+    t_start: np.ndarray
+    t_end: np.ndarray
+    label: np.ndarray
+    score: Optional[np.ndarray] = None
+    gentime: Optional[np.ndarray] = None
+
+    def __len__(self):
+        return len(self.video_id)
+
+    def take(self, rows):
+        """Returns the segments at the given row positions.
+        """
+        return Segments(*[None if getattr(self, f.name) is None else getattr(self, f.name)[rows]
+                          for f in fields(self)])
+
+    def segments(self):
+        """Returns the N x [t-start, t-end] array of the segments.
+        """
+        return np.stack([self.t_start, self.t_end], axis=1)
+
 
 class ANETdetection(object):
 
@@ -16,7 +54,7 @@ class ANETdetection(object):
                  prediction_fields=PREDICTION_FIELDS,
                  tiou_thresholds=np.linspace(0.5, 0.95, 10), 
                  subset='validation', verbose=False, 
-                 check_status=True):
+                 check_status=True, n_jobs=1):
         if not ground_truth_filename:
             raise IOError('Please input a valid ground truth file.')
         if not prediction_filename:
@@ -29,16 +67,19 @@ class ANETdetection(object):
         self.ap = None
         self.tdiff = None
         self.check_status = check_status
+        self.n_jobs = n_jobs
         self.num_class = opt["num_of_class"]
         # Retrieve blocked videos from server.
         if self.check_status:
-            self.blocked_videos = get_blocked_videos()
+            self.blocked_videos = frozenset(get_blocked_videos())
         else:
-            self.blocked_videos = list()
+            self.blocked_videos = frozenset()
         # Import ground truth and predictions.
         self.ground_truth, self.activity_index, cidx = self._import_ground_truth(
             ground_truth_filename)
         self.prediction = self._import_prediction(prediction_filename, cidx)
+        # Shared int32 video codes for ground truth and predictions.
+        self.video_names = _encode_videos(self.ground_truth, self.prediction)
 
         if self.verbose:
             print('[INIT] Loaded annotations from {} subset.'.format(subset))
@@ -59,38 +100,32 @@ class ANETdetection(object):
 
         Outputs
         -------
-        ground_truth : df
-            Data frame containing the ground truth instances.
+        ground_truth : Segments
+            Ground truth instances.
         activity_index : dict
             Dictionary containing class index.
         """
-        with open(ground_truth_filename, 'r') as fobj:
-            data = json.load(fobj)
+        data = load_json(ground_truth_filename)
         # Checking format
         if not all([field in list(data.keys()) for field in self.gt_fields]):
             raise IOError('Please input a valid ground truth file.')
 
         # Read ground truth data.
-        activity_index, cidx = {}, 0
-
-        video_lst, t_start_lst, t_end_lst, label_lst = [], [], [], []
-        for videoid, v in data['database'].items():
-            if self.subset not in v['subset']:
-                continue
- 
-            for ann in v['annotations']:
-                if ann['label'] not in activity_index:
-                    activity_index[ann['label']] = cidx
-                    cidx += 1
-                video_lst.append(videoid)
-                t_start_lst.append(ann['segment'][0])
-                t_end_lst.append(ann['segment'][1])
-                label_lst.append(activity_index[ann['label']])
-        
-        ground_truth = pd.DataFrame({'video-id': video_lst,
-                                     't-start': t_start_lst,
-                                     't-end': t_end_lst,
-                                     'label': label_lst})
+        annotations = [(videoid, ann) for videoid, v in data['database'].items()
+                       if self.subset in v['subset'] for ann in v['annotations']]
+        label_names = [ann['label'] for _, ann in annotations]
+        # Classes are indexed in order of first appearance.
+        activity_index = {label: cidx for cidx, label in enumerate(dict.fromkeys(label_names))}
+        cidx = len(activity_index)
+
+        n = len(annotations)
+        t_end = np.fromiter((ann['segment'][1] for _, ann in annotations), dtype=np.float64, count=n)
+        ground_truth = Segments(
+            video_id=np.array([videoid for videoid, _ in annotations], dtype=object),
+            t_start=np.fromiter((ann['segment'][0] for _, ann in annotations), dtype=np.float64, count=n),
+            # FIX: Handle NaN or invalid values in ground truth times
+            t_end=np.nan_to_num(t_end, nan=0.0, posinf=0.0, neginf=0.0),
+            label=np.fromiter((activity_index[label] for label in label_names), dtype=np.int32, count=n))
 
         return ground_truth, activity_index, cidx
 
@@ -105,41 +140,35 @@ class ANETdetection(object):
 
         Outputs
         -------
-        prediction : df
-            Data frame containing the prediction instances.
+        prediction : Segments
+            Prediction instances.
         """
-        with open(prediction_filename, 'r') as fobj:
-            data = json.load(fobj)
+        data = load_json(prediction_filename)
         # Checking format...
         if not all([field in list(data.keys()) for field in self.pred_fields]):
             raise IOError('Please input a valid prediction file.')
 
         # Read predicitons.
-        video_lst, t_start_lst, t_end_lst = [], [], []
-        label_lst, score_lst = [], []
-        gentime_lst = []
-        for videoid, v in data['results'].items():
-            if videoid in self.blocked_videos:
-                continue
-            for result in v:
-                if result['label'] not in self.activity_index.keys():
-                    continue
+        activity_index = self.activity_index
+        results = [(videoid, result) for videoid, v in data['results'].items() for result in v]
+
+        n = len(results)
+        gentime = np.fromiter((result['gentime'] for _, result in results), dtype=np.float64, count=n)
+        prediction = Segments(
+            video_id=np.array([videoid for videoid, _ in results], dtype=object),
+            t_start=np.fromiter((result['segment'][0] for _, result in results), dtype=np.float64, count=n),
+            t_end=np.fromiter((result['segment'][1] for _, result in results), dtype=np.float64, count=n),
+            label=np.fromiter((activity_index.get(result['label'], -1) for _, result in results),
+                              dtype=np.int32, count=n),
+            score=np.fromiter((result['score'] for _, result in results), dtype=np.float64, count=n),
+            # FIX: Handle NaN or invalid values in gentime
+            gentime=np.nan_to_num(gentime, nan=0.0, posinf=0.0, neginf=0.0))
 
-                label = self.activity_index[result['label']]
-                video_lst.append(videoid)
-                t_start_lst.append(result['segment'][0])
-                t_end_lst.append(result['segment'][1])
-                label_lst.append(label)
-                score_lst.append(result['score'])
-                gentime_lst.append(result['gentime'])
-
-        prediction = pd.DataFrame({'video-id': video_lst,
-                                   't-start': t_start_lst,
-                                   't-end': t_end_lst,
-                                   'label': label_lst,
-                                   'score': score_lst,
-                                   'gentime': gentime_lst})
-        return prediction
+        # Drop predictions of blocked videos and of classes without ground truth.
+        keep = prediction.label >= 0
+        if self.blocked_videos:
+            keep &= ~np.isin(prediction.video_id, list(self.blocked_videos))
+        return prediction.take(keep)
 
     def wrapper_compute_average_precision(self):
         """Computes average precision for each class in the subset.
@@ -148,13 +177,27 @@ class ANETdetection(object):
         tdiff = np.zeros((len(self.tiou_thresholds), len(list(self.activity_index.items()))))
         cnt_tp = np.zeros((len(self.tiou_thresholds), len(list(self.activity_index.items()))))
         
-        for activity, cidx in self.activity_index.items():
-            gt_idx = self.ground_truth['label'] == cidx
-            pred_idx = self.prediction['label'] == cidx
-            ap[:,cidx], tdiff[:,cidx], cnt_tp[:,cidx] = compute_average_precision_detection(
-                self.ground_truth.loc[gt_idx].reset_index(drop=True),
-                self.prediction.loc[pred_idx].reset_index(drop=True),
-                tiou_thresholds=self.tiou_thresholds)
+        # Row positions of every ground truth class, computed in a single pass.
+        gt_by_label = _group_rows(self.ground_truth.label, len(self.activity_index))
+        # Predictions sorted once by (label, -score), so every class is a
+        # contiguous span already in decreasing score order.
+        prediction = self.prediction.take(np.lexsort((-self.prediction.score, self.prediction.label)))
+        pred_bounds = np.searchsorted(prediction.label, np.arange(len(self.activity_index) + 1))
+
+        # Classes without ground truth or predictions keep zero scores.
+        classes = [cidx for cidx in self.activity_index.values()
+                   if len(gt_by_label[cidx]) and pred_bounds[cidx+1] > pred_bounds[cidx]]
+
+        # Classes are independent, so they are evaluated in parallel.
+        results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_compute_class)(
+                self.ground_truth.take(gt_by_label[cidx]),
+                prediction.take(slice(pred_bounds[cidx], pred_bounds[cidx+1])),
+                self.tiou_thresholds)
+            for cidx in classes)
+
+        for cidx, result in zip(classes, results):
+            ap[:,cidx], tdiff[:,cidx], cnt_tp[:,cidx] = result
                 
         sum_tdiff = np.sum(tdiff, axis=1)
         total_tp = np.sum(cnt_tp, axis=1)
@@ -203,6 +246,56 @@ def compute_average_precision_detection(ground_truth, prediction, tiou_threshold
     ap : float
         Average precision score.
     """
+    ground_truth = _segments_from_frame(ground_truth)
+    prediction = _segments_from_frame(prediction)
+    _encode_videos(ground_truth, prediction)
+    return _compute_class(ground_truth, prediction, tiou_thresholds)
+
+
+def _segments_from_frame(df):
+    """Converts a data frame with the ANETdetection column names to Segments.
+    """
+    def column(name):
+        return df[name].to_numpy() if name in df else None
+
+    return Segments(video_id=column('video-id'), t_start=column('t-start'), t_end=column('t-end'),
+                    label=column('label'), score=column('score'), gentime=column('gentime'))
+
+
+def _encode_videos(ground_truth, prediction):
+    """Replaces the video ids of both Segments by shared int32 codes in place
+    and returns the video names, indexed by code.
+    """
+    codes, names = pd.factorize(np.concatenate([ground_truth.video_id, prediction.video_id]))
+    ground_truth.video_id, prediction.video_id = np.split(codes.astype(np.int32), [len(ground_truth)])
+    return names
+
+
+def _group_rows(keys, n_groups):
+    """Returns the row positions of each integer key in [0, n_groups).
+    """
+    order = np.argsort(keys, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(keys, minlength=n_groups))[:-1])
+
+
+def _compute_class(ground_truth, prediction, tiou_thresholds):
+    """Computes average precision, summed time difference and number of true
+    positives of a single class.
+
+    Parameters
+    ----------
+    ground_truth : Segments
+        Ground truth instances of the class, with encoded video ids.
+    prediction : Segments
+        Prediction instances of the class, with score and gentime.
+    tiou_thresholds : 1darray
+        Temporal intersection over union threshold.
+
+    Outputs
+    -------
+    ap, tdiff, cnt_tp : 1darray
+        Per threshold average precision, time difference and true positives.
+    """
     # Handle empty predictions or ground truth
     if len(prediction) == 0 or len(ground_truth) == 0:
         ap = np.zeros(len(tiou_thresholds))
@@ -211,95 +304,228 @@ def compute_average_precision_detection(ground_truth, prediction, tiou_threshold
         return ap, tdiff, cnt_tp
     
     npos = float(len(ground_truth))
-    lock_gt = np.ones((len(tiou_thresholds),len(ground_truth))) * -1
+    tiou_thresholds = np.asarray(tiou_thresholds)
+
+    # Sort predictions by decreasing score order; ties keep their file order.
+    # The stable sort is linear on predictions that are already sorted.
+    prediction = prediction.take(np.argsort(-prediction.score, kind='stable'))
+
+    gt_segments = ground_truth.segments()
+    pred_segments = prediction.segments()
 
-    # Sort predictions by decreasing score order.
-    sort_idx = prediction['score'].values.argsort()[::-1]
-    prediction = prediction.loc[sort_idx].reset_index(drop=True)
+    gt_video = ground_truth.video_id
+    pred_video = prediction.video_id
+    n_videos = max(gt_video.max(), pred_video.max()) + 1
 
-    # Initialize true positive and false positive vectors.
-    tp = np.zeros((len(tiou_thresholds), len(prediction)))
-    fp = np.zeros((len(tiou_thresholds), len(prediction)))
-    timediff = np.zeros((len(tiou_thresholds), len(prediction)))
+    # Bucket ground truth and prediction rows by video.
+    gt_order = np.argsort(gt_video, kind='stable')
+    gt_counts = np.bincount(gt_video, minlength=n_videos)
+    gt_offsets = np.concatenate([[0], np.cumsum(gt_counts)])
 
-    # Adaptation to query faster
-    ground_truth_gbvn = ground_truth.groupby('video-id')
+    pred_order = np.argsort(pred_video, kind='stable')
+    pred_counts = np.bincount(pred_video, minlength=n_videos)
+    pred_offsets = np.concatenate([[0], np.cumsum(pred_counts)])
+    pred_row = np.empty(len(pred_video), dtype=np.int64)
+    pred_row[pred_order] = np.arange(len(pred_video)) - pred_offsets[pred_video[pred_order]]
+
+    # IoU matrices (|P| x |G|) of all videos, flattened one after the other.
+    iou_offsets = np.concatenate([[0], np.cumsum(pred_counts * gt_counts)])
+    iou_flat = np.empty(iou_offsets[-1])
+    for v in np.flatnonzero(pred_counts * gt_counts):
+        iou_flat[iou_offsets[v]:iou_offsets[v+1]] = wrapper_segment_iou(
+            gt_segments[gt_order[gt_offsets[v]:gt_offsets[v+1]]],
+            pred_segments[pred_order[pred_offsets[v]:pred_offsets[v+1]]]).ravel()
+    # Two zero-length segments have no union; as in the original evaluation,
+    # their NaN overlap ranks first and passes every threshold.
+    np.nan_to_num(iou_flat, copy=False, nan=np.inf)
 
     # Assigning true positive to truly grount truth instances.
-    for idx, this_pred in prediction.iterrows():
-        try:
-            # Check if there is at least one ground truth in the video associated.
-            ground_truth_videoid = ground_truth_gbvn.get_group(this_pred['video-id'])
-        except Exception as e:
+    tp, fp, timediff = _match_predictions(iou_flat, iou_offsets, gt_offsets, gt_order,
+                                          pred_video, pred_row, tiou_thresholds,
+                                          prediction.gentime, ground_truth.t_end)
+
+    # Computing prec-rec for all thresholds at once. Every prediction is
+    # either a true or a false positive, so the denominators are never zero.
+    tp_cum = np.cumsum(tp, axis=1, dtype=np.int64)
+    fp_cum = np.cumsum(fp, axis=1, dtype=np.int64)
+    rec = tp_cum / npos
+    prec = tp_cum / (tp_cum + fp_cum)
+
+    ap = interpolated_prec_rec(prec, rec)
+    # Time differences are finite since gentime and t-end are sanitized on import.
+    tdiff = np.sum(timediff, axis=1, dtype=np.float64)
+    cnt_tp = tp_cum[:, -1]
+    
+    return ap, tdiff, cnt_tp
+
+
+# Number of best overlapping ground truth instances sorted per prediction.
+_TOP_K = 16
+
+
+def _top_overlaps(tiou_arr, k):
+    """Returns, in index order, the positions of the k largest overlaps plus
+    any ties of the k-th one, so that their stable sort is a prefix of the
+    stable sort of all overlaps.
+    """
+    if k >= tiou_arr.shape[0]:
+        return np.arange(tiou_arr.shape[0])
+    kth = -np.partition(-tiou_arr, k-1)[k-1]
+    if np.isnan(kth):
+        return np.arange(tiou_arr.shape[0])
+    return np.flatnonzero(tiou_arr >= kth)
+
+
+def _match_predictions_numpy(iou_flat, iou_offsets, gt_offsets, gt_order, pred_video, pred_row,
+                             tiou_thresholds, gentime_pred, gentime_gt):
+    """Greedily assigns score-sorted predictions to ground truth instances.
+
+    Parameters
+    ----------
+    iou_flat : 1darray
+        IoU matrices (predictions x ground truth) of all videos, flattened.
+    iou_offsets : 1darray
+        Start of the IoU matrix of each video in iou_flat.
+    gt_offsets : 1darray
+        Start of the ground truth rows of each video in gt_order.
+    gt_order : 1darray
+        Ground truth row indices grouped by video.
+    pred_video : 1darray
+        Video code of each prediction, in decreasing score order.
+    pred_row : 1darray
+        Row of each prediction in the IoU matrix of its video.
+    tiou_thresholds : 1darray
+        Temporal intersection over union threshold.
+    gentime_pred : 1darray
+        Generation time of each prediction.
+    gentime_gt : 1darray
+        Ending time of each ground truth instance.
+
+    Outputs
+    -------
+    tp, fp : 2darray
+        Per threshold true positive and false positive flags (uint8) of
+        each prediction.
+    timediff : 2darray
+        Per threshold time difference (float32) of each prediction.
+    """
+    tp = np.zeros((len(tiou_thresholds), len(pred_video)), dtype=np.uint8)
+    fp = np.zeros((len(tiou_thresholds), len(pred_video)), dtype=np.uint8)
+    timediff = np.zeros((len(tiou_thresholds), len(pred_video)), dtype=np.float32)
+    locked = np.zeros((len(tiou_thresholds), len(gt_order)), dtype=bool)
+    # Number of thresholds at which each ground truth is still free.
+    free_count = np.full(len(gt_order), len(tiou_thresholds), dtype=np.int32)
+
+    for idx in range(len(pred_video)):
+        v = pred_video[idx]
+        n_gt = gt_offsets[v+1] - gt_offsets[v]
+        if n_gt == 0:
+            # No ground truth in the video associated.
             fp[:, idx] = 1
             continue
 
-        this_gt = ground_truth_videoid.reset_index()
-        tiou_arr = segment_iou(this_pred[['t-start', 't-end']].values,
-                               this_gt[['t-start', 't-end']].values)
-        
-        # FIX: Handle NaN or invalid values in gentime
-        gentime_pred = this_pred['gentime']
-        if pd.isna(gentime_pred) or np.isinf(gentime_pred):
-            gentime_pred = 0.0
-            
-        gentime_gt_arr = this_gt['t-end'].values
-        
-        # FIX: Handle NaN or invalid values in ground truth times
-        gentime_gt_arr = np.nan_to_num(gentime_gt_arr, nan=0.0, posinf=0.0, neginf=0.0)
-        
-        tiou_sorted_idx = tiou_arr.argsort()[::-1]
-        for tidx, tiou_thr in enumerate(tiou_thresholds):
+        # Ground truth locked at every threshold can not be matched anymore.
+        gt_rows = gt_order[gt_offsets[v]:gt_offsets[v+1]]
+        free = free_count[gt_rows] > 0
+        if not free.any():
+            fp[:, idx] = 1
+            continue
+
+        row_start = iou_offsets[v] + pred_row[idx] * n_gt
+        tiou_arr = iou_flat[row_start:row_start+n_gt][free]
+        candidates = gt_rows[free]
+
+        # For every threshold, take the best overlapping ground truth that is
+        # still free. Only the top-k overlaps are sorted; the full order is
+        # needed when all of them are locked but still above a threshold.
+        top = _top_overlaps(tiou_arr, max(_TOP_K, len(tiou_thresholds)))
+        tiou_sorted_idx = top[np.argsort(-tiou_arr[top], kind='stable')]
+        candidate = (tiou_arr[tiou_sorted_idx] >= tiou_thresholds[:, None]) & ~locked[:, candidates[tiou_sorted_idx]]
+        matched = candidate.any(axis=1)
+        if len(top) < len(tiou_arr) and not matched[tiou_arr[tiou_sorted_idx[-1]] >= tiou_thresholds].all():
+            tiou_sorted_idx = np.argsort(-tiou_arr, kind='stable')
+            candidate = (tiou_arr[tiou_sorted_idx] >= tiou_thresholds[:, None]) & ~locked[:, candidates[tiou_sorted_idx]]
+            matched = candidate.any(axis=1)
+        sorted_gt = candidates[tiou_sorted_idx]
+        gt_idx = sorted_gt[candidate.argmax(axis=1)[matched]]
+
+        tp[matched, idx] = 1
+        fp[~matched, idx] = 1
+        timediff[matched, idx] = gentime_pred[idx] - gentime_gt[gt_idx]
+        locked[matched, gt_idx] = True
+        np.subtract.at(free_count, gt_idx, 1)
+
+    return tp, fp, timediff
+
+
+def _match_predictions_loop(iou_flat, iou_offsets, gt_offsets, gt_order, pred_video, pred_row,
+                            tiou_thresholds, gentime_pred, gentime_gt):
+    """Loop version of _match_predictions_numpy, compiled with numba.
+    """
+    tp = np.zeros((tiou_thresholds.shape[0], pred_video.shape[0]), dtype=np.uint8)
+    fp = np.zeros((tiou_thresholds.shape[0], pred_video.shape[0]), dtype=np.uint8)
+    timediff = np.zeros((tiou_thresholds.shape[0], pred_video.shape[0]), dtype=np.float32)
+    locked = np.zeros((tiou_thresholds.shape[0], gt_order.shape[0]), dtype=np.bool_)
+    free_count = np.full(gt_order.shape[0], tiou_thresholds.shape[0], dtype=np.int32)
+
+    for idx in range(pred_video.shape[0]):
+        v = pred_video[idx]
+        n_gt = gt_offsets[v+1] - gt_offsets[v]
+        if n_gt == 0:
+            fp[:, idx] = 1
+            continue
+
+        gt_rows = gt_order[gt_offsets[v]:gt_offsets[v+1]]
+        free = free_count[gt_rows] > 0
+        if not free.any():
+            fp[:, idx] = 1
+            continue
+
+        row_start = iou_offsets[v] + pred_row[idx] * n_gt
+        tiou_arr = iou_flat[row_start:row_start+n_gt][free]
+        candidates = gt_rows[free]
+        top = _top_overlaps(tiou_arr, max(_TOP_K, tiou_thresholds.shape[0]))
+        k = top.shape[0]
+        tiou_sorted_idx = top[np.argsort(-tiou_arr[top], kind='mergesort')]
+        is_full = k == tiou_arr.shape[0]
+        for tidx in range(tiou_thresholds.shape[0]):
+            exhausted = True
             for jdx in tiou_sorted_idx:
-                if tiou_arr[jdx] < tiou_thr:
-                    fp[tidx, idx] = 1
+                if tiou_arr[jdx] < tiou_thresholds[tidx]:
+                    exhausted = False
                     break
-                if lock_gt[tidx, this_gt.loc[jdx]['index']] >= 0:
+                gt_idx = candidates[jdx]
+                if locked[tidx, gt_idx]:
                     continue
-                # Assign as true positive after the filters above.
                 tp[tidx, idx] = 1
-                
-                # FIX: Calculate time difference safely
-                time_diff = gentime_pred - gentime_gt_arr[jdx]
-                # Handle potential NaN or Inf values
-                if pd.isna(time_diff) or np.isinf(time_diff):
-                    time_diff = 0.0
-                timediff[tidx, idx] = time_diff
-                
-                lock_gt[tidx, this_gt.loc[jdx]['index']] = idx
+                timediff[tidx, idx] = gentime_pred[idx] - gentime_gt[gt_idx]
+                locked[tidx, gt_idx] = True
+                free_count[gt_idx] -= 1
+                exhausted = False
                 break
-
-            if fp[tidx, idx] == 0 and tp[tidx, idx] == 0:
+            if exhausted and not is_full:
+                # All top-k overlaps are locked; continue on the full order.
+                tiou_sorted_idx = np.argsort(-tiou_arr, kind='mergesort')
+                is_full = True
+                for jdx in tiou_sorted_idx[k:]:
+                    if tiou_arr[jdx] < tiou_thresholds[tidx]:
+                        break
+                    gt_idx = candidates[jdx]
+                    if locked[tidx, gt_idx]:
+                        continue
+                    tp[tidx, idx] = 1
+                    timediff[tidx, idx] = gentime_pred[idx] - gentime_gt[gt_idx]
+                    locked[tidx, gt_idx] = True
+                    free_count[gt_idx] -= 1
+                    break
+            if tp[tidx, idx] == 0:
                 fp[tidx, idx] = 1
 
-    ap = np.zeros(len(tiou_thresholds))
-    tdiff = np.zeros(len(tiou_thresholds))
-    cnt_tp = np.zeros(len(tiou_thresholds))
+    return tp, fp, timediff
 
-    for tidx in range(len(tiou_thresholds)):
-        # Computing prec-rec
-        this_tp = np.cumsum(tp[tidx,:]).astype(float)
-        this_fp = np.cumsum(fp[tidx,:]).astype(float)
 
-        rec = this_tp / npos
-        prec = this_tp / (this_tp + this_fp)
-        
-        # FIX: Handle edge cases in precision-recall calculation
-        prec = np.nan_to_num(prec, nan=0.0, posinf=0.0, neginf=0.0)
-        rec = np.nan_to_num(rec, nan=0.0, posinf=0.0, neginf=0.0)
-        
-        ap[tidx] = interpolated_prec_rec(prec, rec)
-        
-        # FIX: Handle time difference calculation safely
-        this_tdiff = np.cumsum(timediff[tidx,:]).astype(float)
-        if len(this_tdiff) == 0 or this_tp[-1] == 0:
-            tdiff[tidx] = 0.0
-        else:
-            tdiff[tidx] = this_tdiff[-1]
-            # Handle NaN or Inf values
-            if pd.isna(tdiff[tidx]) or np.isinf(tdiff[tidx]):
-                tdiff[tidx] = 0.0
-                
-        cnt_tp[tidx] = this_tp[-1]
-    
-    return ap, tdiff, cnt_tp
\ No newline at end of file
+if njit is not None:
+    _top_overlaps = njit(cache=True)(_top_overlaps)
+    _match_predictions = njit(cache=True)(_match_predictions_loop)
+else:
+    _match_predictions = _match_predictions_numpy
@@ -1,26 +1,50 @@
+import functools
 import json
 #import urllib.request, urllib.error, urllib.parse
 
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 API = 'http://ec2-52-11-11-89.us-west-2.compute.amazonaws.com/challenge17/api.py'
 
+@functools.lru_cache(maxsize=1)
 def get_blocked_videos(api=API):
 #    api_url = '{}?action=get_blocked'.format(api)
 #    req = urllib.request.Request(api_url)
 #    response = urllib.request.urlopen(req)
-#    return json.loads(response.read())
-    return list()
+#    return frozenset(json.loads(response.read()))
+    return frozenset()
+
+def load_json(filename):
+    """Reads a json file, with the C parser from orjson when it is available.
+    """
+    with open(filename, 'rb') as fobj:
+        raw = fobj.read()
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN/Infinity literals written by json.dump.
+            pass
+    return json.loads(raw)
 
 def interpolated_prec_rec(prec, rec):
     """Interpolated AP - VOCdevkit from VOC 2011.
+
+    prec and rec can also be 2-dim arrays holding one curve per row, in
+    which case the AP of every row is returned.
     """
-    mprec = np.hstack([[0], prec, [0]])
-    mrec = np.hstack([[0], rec, [1]])
-    for i in range(len(mprec) - 1)[::-1]:
-        mprec[i] = max(mprec[i], mprec[i + 1])
-    idx = np.where(mrec[1::] != mrec[0:-1])[0] + 1
-    ap = np.sum((mrec[idx] - mrec[idx - 1]) * mprec[idx])
+    prec, rec = np.asarray(prec, dtype=float), np.asarray(rec, dtype=float)
+    zeros = np.zeros(prec.shape[:-1] + (1,))
+    mprec = np.concatenate([zeros, prec, zeros], axis=-1)
+    mrec = np.concatenate([zeros, rec, zeros + 1], axis=-1)
+    mprec = np.maximum.accumulate(mprec[..., ::-1], axis=-1)[..., ::-1]
+    # Steps where the recall does not change contribute zero.
+    ap = np.sum(np.diff(mrec, axis=-1) * mprec[..., 1:], axis=-1)
     return ap
 
 def segment_iou(target_segment, candidate_segments):
@@ -68,9 +92,13 @@ def wrapper_segment_iou(target_segments, candidate_segments):
     if candidate_segments.ndim != 2 or target_segments.ndim != 2:
         raise ValueError('Dimension of arguments is incorrect')
 
-    n, m = candidate_segments.shape[0], target_segments.shape[0]
-    tiou = np.empty((n, m))
-    for i in range(m):
-        tiou[:, i] = segment_iou(target_segments[i,:], candidate_segments)
+    tt1 = np.maximum(target_segments[:, 0], candidate_segments[:, 0, None])
+    tt2 = np.minimum(target_segments[:, 1], candidate_segments[:, 1, None])
+    # Intersection including Non-negative overlap score.
+    segments_intersection = (tt2 - tt1).clip(0)
+    # Segment union.
+    segments_union = (candidate_segments[:, 1] - candidate_segments[:, 0])[:, None] \
+      + (target_segments[:, 1] - target_segments[:, 0]) - segments_intersection
+    tiou = segments_intersection.astype(float) / segments_union
 
     return tiou
@@ -276,6 +276,7 @@ class VideoDataSet(data.Dataset):
                     self.label_name.append(seg['label'])
         
         self.label_name.sort()            
+        self.label_to_idx = {name: idx for idx, name in enumerate(self.label_name)}
         self.video_list = list(self.video_dict.keys())
         print ("%s subset video numbers: %d" %(self.subset,len(self.video_list)))
     
@@ -294,7 +295,7 @@ class VideoDataSet(data.Dataset):
                 tmp_info=video_labels[j]
                 tmp_start= tmp_info['segment'][0]*second_to_frame
                 tmp_end  = tmp_info['segment'][1]*second_to_frame
-                tmp_label=self.label_name.index(tmp_info['label'])
+                tmp_label=self.label_to_idx[tmp_info['label']]
                 gt_bbox.append([tmp_start,tmp_end,tmp_label])
                 gt_edlen.append([gt_bbox[-1][1], gt_bbox[-1][1]-gt_bbox[-1][0],tmp_label])
                               
@@ -467,6 +468,10 @@ class VideoDataSet(data.Dataset):
      
         return feature           
     
+    def _get_video_features(self,video_name):
+        # all frames of a video in one read, for callers that walk through it
+        return self._get_base_data(video_name,0,None)
+    
     def _get_train_label_with_class(self,video_name,st,ed): 
         duration=len(self.match_score[video_name])
         st_padding=0
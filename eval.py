@@ -7,11 +7,11 @@ import numpy as np
 
 def run_evaluation_detection(opt, ground_truth_filename, prediction_filename, 
                    tiou_thresholds=np.linspace(0.5, 0.95, 10),
-                   subset='validation', verbose=True):
+                   subset='validation', verbose=True, n_jobs=1):
 
     anet_detection = ANETdetection(opt, ground_truth_filename, prediction_filename,
                                    subset=subset, tiou_thresholds=tiou_thresholds,
-                                   verbose=verbose, check_status=False)
+                                   verbose=verbose, check_status=False, n_jobs=n_jobs)
     anet_detection.evaluate()
     
     ap = anet_detection.ap
@@ -20,14 +20,16 @@ def run_evaluation_detection(opt, ground_truth_filename, prediction_filename,
     
     return (mAP, ap, tdiff)
 
-def evaluation_detection(opt, verbose=True):
+def evaluation_detection(opt, verbose=True, n_jobs=1):
+    # Classes are evaluated in n_jobs processes; the default stays serial so
+    # evaluation during training does not compete with the data loaders.
     
     mAP, AP, tdiff = run_evaluation_detection(
         opt,
         opt["video_anno"].format(opt["split"]),
         opt["result_file"].format(opt['exp']),
         tiou_thresholds=np.linspace(0.1, 0.50, 5),
-        subset=opt['inference_subset'], verbose=verbose)
+        subset=opt['inference_subset'], verbose=verbose, n_jobs=n_jobs)
     
     if verbose:    
         print('mAP')
@@ -1,4 +1,6 @@
 import numpy as np
+import torch
+import torchvision
 
 def non_max_suppression(proposals, overlapThresh=0.3):
     # if there are no intervals, return an empty list
@@ -42,6 +44,47 @@ def non_max_suppression(proposals, overlapThresh=0.3):
     return sorted_proposal
     
     
+def batched_interval_nms(st, ed, score, label, overlapThresh=0.3):
+    # hard NMS of 1-D intervals within each label, using torchvision's fused kernel;
+    # intervals are handled as boxes of unit height, returns the kept indices by decreasing score
+    if len(score) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    boxes = np.stack([st, np.zeros_like(st), ed, np.ones_like(ed)], axis=1)
+    boxes = torch.as_tensor(boxes, dtype=torch.float32, device=device)
+    scores = torch.as_tensor(score, dtype=torch.float32, device=device)
+    idxs = torch.as_tensor(label, dtype=torch.int64, device=device)
+    
+    keep = torchvision.ops.batched_nms(boxes, scores, idxs, overlapThresh)
+    return keep.cpu().numpy()
+    
+    
+def interval_nms(st, ed, score, label, overlapThresh=0.3):
+    # array version of non_max_suppression with the same overlap measure and ordering,
+    # returns the kept indices by decreasing score
+    order = np.argsort(-np.asarray(score), kind='stable')
+    st, ed, label = np.asarray(st)[order], np.asarray(ed)[order], np.asarray(label)[order]
+    keep = []
+    # labels never suppress each other, so each one is handled on its own rows only,
+    # which stay in decreasing score order
+    by_label = np.argsort(label, kind='stable')
+    starts = np.unique(label[by_label], return_index=True)[1][1:]
+    for rows in np.split(by_label, starts):
+        l_st, l_ed = st[rows], ed[rows]
+        suppressed = np.zeros(len(rows), dtype=bool)
+        for idx in range(len(rows)):
+            if suppressed[idx]:
+                continue
+            keep.append(rows[idx])
+            lst = np.maximum(l_st[idx], l_st[idx+1:])
+            sed = np.minimum(l_ed[idx], l_ed[idx+1:])
+            sst = np.minimum(l_st[idx], l_st[idx+1:])
+            led = np.maximum(l_ed[idx], l_ed[idx+1:])
+            suppressed[idx+1:] |= (sed-lst) / np.maximum(led-sst, 1) > overlapThresh
+    return order[np.sort(np.asarray(keep, dtype=np.int64))]
+    
+    
 def check_overlap_proposal(proposal_list, new_proposal, overlapThresh=0.3):
     for proposal in proposal_list:
         st = proposal['segment'][0]
@@ -14,6 +14,8 @@ class MultiCrossEntropyLoss(nn.Module):
         self.reduce = reduce
         self.gamma_ = torch.zeros(self.num_classes).cuda() + 0.025
         self.gamma_f = 0.05
+        # Label of the current batch, read by grad_hook during backward.
+        self.grad_target = None
 
         self.register_buffer('pos_grad', torch.zeros(self.num_classes-1).cuda())
         self.register_buffer('neg_grad', torch.zeros(self.num_classes-1).cuda())
@@ -54,6 +56,9 @@ class MultiCrossEntropyLoss(nn.Module):
     
     def collect_grad(self, target, grad):
         grad = torch.abs(grad.reshape(-1, grad.shape[-1])).cuda()
+        # A non-finite gradient would stay in the running sums for good, so it
+        # counts as zero; masked on the device to avoid a sync in backward.
+        grad = torch.where(torch.isfinite(grad).all(), grad, torch.zeros_like(grad))
         target = target.reshape(-1, target.shape[-1]).cuda()
         pos_grad = torch.sum(grad * target, dim=0)[:-1]
         neg_grad = torch.sum(grad * (1 - target), dim=0)[:-1]
@@ -62,6 +67,9 @@ class MultiCrossEntropyLoss(nn.Module):
         self.pos_neg = torch.clamp(self.pos_grad / (self.neg_grad + 1e-10), min=0, max=1)
         self.pos_neg = self.map_func(self.pos_neg, 1)
     
+    def grad_hook(self, grad):
+        self.collect_grad(self.grad_target, grad)
+    
 
 def cls_loss_func(y, output, use_focal=False, weight=None, reduce=True, num_classes=None):
     input_size = y.size()
@@ -1,5 +1,8 @@
 import os
 import json
+import inspect
+import contextlib
+import threading
 import torch
 import torchvision
 import torch.nn.parallel
@@ -10,6 +13,7 @@ import opts_saloon as opts
 
 import time
 import h5py
+from collections import Counter, namedtuple
 from tqdm import tqdm
 from iou_utils import *
 from eval import evaluation_detection
@@ -20,21 +24,67 @@ from loss_func import cls_loss_func, cls_loss_func_, regress_loss_func
 from loss_func import MultiCrossEntropyLoss
 from functools import *
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 import torch
 import numpy as np
-from functools import partial
 from tqdm import tqdm
 
-def train_one_epoch(opt, model, train_dataset, optimizer, warmup=False):
-    train_loader = torch.utils.data.DataLoader(train_dataset,
-                                                batch_size=opt['batch_size'], shuffle=True,
-                                                num_workers=0, pin_memory=True, drop_last=False)      
-    epoch_cost = 0
-    epoch_cost_cls = 0
-    epoch_cost_reg = 0
-    epoch_cost_snip = 0
+def loader_kwargs(opt):
+    """Worker and pinning settings shared by the DataLoaders.
     
-    valid_batches = 0  # Track number of valid batches processed
+    The loaders are built anew for every epoch and evaluation, so their
+    workers are not kept alive between iterations.
+    """
+    num_workers = opt.get('num_workers', 4)
+    kwargs = {'num_workers': num_workers, 'pin_memory': True}
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=opt.get('prefetch_factor', 2))
+    return kwargs
+
+def compile_model(opt, model, mode='max-autotune'):
+    # Inductor specializes on the input shapes, which are fixed per batch here.
+    # Inference passes mode='reduce-overhead', which also replays CUDA graphs.
+    if opt.get('compile') and hasattr(torch, 'compile'):
+        return torch.compile(model, mode=opt.get('compile_mode') or mode, dynamic=False)
+    return model
+
+def autocast_forward(opt, module):
+    # With opt['amp_inference'] the forward runs under bf16 autocast and its
+    # outputs are cast back to float32. The weight cast cache is disabled so
+    # the forward can also be captured in a CUDA graph.
+    if not opt.get('amp_inference'):
+        return module
+    def forward(inputs):
+        with torch.amp.autocast('cuda', dtype=torch.bfloat16, cache_enabled=False):
+            outputs = module(inputs)
+        if torch.is_tensor(outputs):
+            return outputs.float()
+        return tuple(output.float() for output in outputs)
+    return forward
+
+def train_one_epoch(opt, model, train_dataset, optimizer, warmup=False, sampler=None, amp=True):
+    train_loader = torch.utils.data.DataLoader(train_dataset,
+                                                batch_size=opt['batch_size'], shuffle=sampler is None,
+                                                sampler=sampler, drop_last=bool(opt.get('compile')), **loader_kwargs(opt))
+    # Losses are accumulated on the device and read back once per epoch.
+    epoch_cost = torch.zeros((), device='cuda')
+    epoch_cost_cls = torch.zeros((), device='cuda')
+    epoch_cost_reg = torch.zeros((), device='cuda')
+    epoch_cost_snip = torch.zeros((), device='cuda')
+    
+    # Batches with finite inputs and cost, and updates skipped because of
+    # non-finite gradients; counted on the device and read once per epoch.
+    valid_batches = torch.zeros((), dtype=torch.int64, device='cuda')
+    skipped_steps = torch.zeros((), dtype=torch.int64, device='cuda')
     
     total_iter = len(train_dataset) // opt['batch_size']
     cls_loss = MultiCrossEntropyLoss(opt["num_of_class"], focal=True)
@@ -42,124 +92,97 @@ def train_one_epoch(opt, model, train_dataset, optimizer, warmup=False):
     
     model.train()  # Ensure model is in training mode
     
+    # Gradients of accum_steps batches are summed before each update; under DDP
+    # the all-reduce is skipped on all but the last of them.
+    accum_steps = opt.get('accum_steps', 1)
+    alpha, beta, gamma = float(opt['alpha']), float(opt['beta']), float(opt['gamma'])
+    is_ddp = isinstance(model, torch.nn.parallel.DistributedDataParallel)
+    optimizer.zero_grad(set_to_none=True)
+    # The fused Adam kernel skips its update when found_inf is set, without
+    # the host reading the flag; other implementations check it on the host.
+    found_inf = torch.zeros((), device='cuda')
+    device_skip = bool(optimizer.defaults.get('fused'))
+    if device_skip:
+        optimizer.found_inf = found_inf
+    
     for n_iter, (input_data, cls_label, reg_label, snip_label) in enumerate(tqdm(train_loader)):
+        update_step = (n_iter+1) % accum_steps == 0 or n_iter+1 == len(train_loader)
+        sync_context = model.no_sync() if is_ddp and not update_step else contextlib.nullcontext()
         try:
             if warmup:
+                warmup_lr = n_iter * opt['lr'] / total_iter
                 for g in optimizer.param_groups:
-                    g['lr'] = n_iter * (opt['lr']) / total_iter
-            
-            # Safe forward pass
-            input_data = input_data.float().cuda()
-            
-            # Check input for NaN/Inf
-            if torch.isnan(input_data).any() or torch.isinf(input_data).any():
-                print(f"Warning: NaN/Inf detected in input data at batch {n_iter}, skipping...")
-                continue
-            
-            act_cls, act_reg, snip_cls = model(input_data)
-            
-            # Check model outputs for NaN/Inf
-            if (torch.isnan(act_cls).any() or torch.isinf(act_cls).any() or
-                torch.isnan(act_reg).any() or torch.isinf(act_reg).any() or
-                torch.isnan(snip_cls).any() or torch.isinf(snip_cls).any()):
-                print(f"Warning: NaN/Inf detected in model outputs at batch {n_iter}, skipping...")
-                continue
-            
-            # Register hooks
-            act_cls.register_hook(partial(cls_loss.collect_grad, cls_label))
-            snip_cls.register_hook(partial(snip_loss.collect_grad, snip_label))
-            
-            # Initialize loss components
-            cost_reg = 0
-            cost_cls = 0
-            cost_snip = 0
-            
-            # Classification loss
-            try:
-                loss_cls = cls_loss_func_(cls_loss, cls_label, act_cls)
-                if torch.isnan(loss_cls).any() or torch.isinf(loss_cls).any():
-                    print(f"Warning: NaN/Inf in cls loss at batch {n_iter}")
-                    loss_cls = torch.tensor(0.0, device=loss_cls.device, requires_grad=True)
-                cost_cls = loss_cls
-            except Exception as e:
-                print(f"Error in classification loss calculation at batch {n_iter}: {e}")
-                cost_cls = torch.tensor(0.0, device=act_cls.device, requires_grad=True)
-            
-            # Regression loss
-            try:
-                loss_reg = regress_loss_func(reg_label, act_reg)
-                if torch.isnan(loss_reg).any() or torch.isinf(loss_reg).any():
-                    print(f"Warning: NaN/Inf in reg loss at batch {n_iter}")
-                    loss_reg = torch.tensor(0.0, device=loss_reg.device, requires_grad=True)
-                cost_reg = loss_reg
-            except Exception as e:
-                print(f"Error in regression loss calculation at batch {n_iter}: {e}")
-                cost_reg = torch.tensor(0.0, device=act_reg.device, requires_grad=True)
+                    g['lr'] = warmup_lr
             
-            # Snippet loss
-            try:
-                loss_snip = cls_loss_func_(snip_loss, snip_label, snip_cls)
-                if torch.isnan(loss_snip).any() or torch.isinf(loss_snip).any():
-                    print(f"Warning: NaN/Inf in snip loss at batch {n_iter}")
-                    loss_snip = torch.tensor(0.0, device=loss_snip.device, requires_grad=True)
-                cost_snip = loss_snip
-            except Exception as e:
-                print(f"Error in snippet loss calculation at batch {n_iter}: {e}")
-                cost_snip = torch.tensor(0.0, device=snip_cls.device, requires_grad=True)
+            input_data = input_data.to('cuda', dtype=torch.float32, non_blocking=True)
+            cls_label = cls_label.cuda(non_blocking=True)
+            reg_label = reg_label.cuda(non_blocking=True)
+            snip_label = snip_label.cuda(non_blocking=True)
             
-            # Total cost calculation
-            cost = opt['alpha'] * cost_cls + opt['beta'] * cost_reg + opt['gamma'] * cost_snip
-            
-            # Final check for total cost
-            if torch.isnan(cost).any() or torch.isinf(cost).any():
-                print(f"Warning: NaN/Inf in total cost at batch {n_iter}, skipping...")
-                continue
-            
-            # Backward pass with gradient checking
-            optimizer.zero_grad()
-            cost.backward()
-            
-            # Check gradients for NaN/Inf
-            has_nan_grad = False
-            for name, param in model.named_parameters():
-                if param.grad is not None:
-                    if torch.isnan(param.grad).any() or torch.isinf(param.grad).any():
-                        print(f"Warning: NaN/Inf gradient detected in {name} at batch {n_iter}")
-                        param.grad.data.zero_()  # Zero out bad gradients
-                        has_nan_grad = True
-            
-            if has_nan_grad:
-                print(f"Skipping parameter update for batch {n_iter} due to invalid gradients")
-                continue
-            
-            # Apply gradient clipping
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+            with sync_context:
+                with torch.amp.autocast('cuda', dtype=torch.bfloat16, enabled=amp):
+                    act_cls, act_reg, snip_cls = model(input_data)
+                    
+                    # Register hooks
+                    cls_loss.grad_target = cls_label
+                    snip_loss.grad_target = snip_label
+                    act_cls.register_hook(cls_loss.grad_hook)
+                    snip_cls.register_hook(snip_loss.grad_hook)
+                    
+                    cost_cls = cls_loss_func_(cls_loss, cls_label, act_cls)
+                    cost_reg = regress_loss_func(reg_label, act_reg)
+                    cost_snip = cls_loss_func_(snip_loss, snip_label, snip_cls)
+                    
+                    # Total cost calculation
+                    cost = alpha * cost_cls + beta * cost_reg + gamma * cost_snip
+                
+                # A non-finite input shows up in the cost as well; such
+                # batches are left out of the epoch losses.
+                batch_finite = torch.isfinite(input_data).all() & torch.isfinite(cost).all()
+                
+                # bf16 keeps the float32 exponent range, so neither needs loss scaling.
+                # Non-finite gradients of a bad batch are not dropped here: they
+                # make the norm below non-finite, so the update of the whole
+                # accumulation window is skipped, on every DDP process alike.
+                (cost / accum_steps).backward()
             
-            # Update parameters
-            optimizer.step()
+            if update_step:
+                total_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+                found_inf.copy_(~torch.isfinite(total_norm))
+                skipped_steps += found_inf.long()
+                if device_skip or not found_inf:
+                    optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
             
-            # Accumulate losses (only for valid batches)
-            epoch_cost_cls += cost_cls.detach().cpu().numpy()
-            epoch_cost_reg += cost_reg.detach().cpu().numpy()
-            epoch_cost_snip += cost_snip.detach().cpu().numpy()
-            epoch_cost += cost.detach().cpu().numpy()
+            # Accumulate losses
+            epoch_cost_cls += torch.where(batch_finite, cost_cls.detach().sum(), 0.0)
+            epoch_cost_reg += torch.where(batch_finite, cost_reg.detach().sum(), 0.0)
+            epoch_cost_snip += torch.where(batch_finite, cost_snip.detach().sum(), 0.0)
+            epoch_cost += torch.where(batch_finite, cost.detach().sum(), 0.0)
             
-            valid_batches += 1
+            valid_batches += batch_finite
             
         except Exception as e:
             print(f"Unexpected error at batch {n_iter}: {e}")
+            if update_step:
+                # Partial gradients of the window must not reach the next one.
+                optimizer.zero_grad(set_to_none=True)
             continue
     
+    optimizer.found_inf = None
+    valid_batches = valid_batches.item()
+    
     # Handle case where no valid batches were processed
     if valid_batches == 0:
         print("Warning: No valid batches processed in this epoch!")
         return n_iter, 0.0, 0.0, 0.0, 0.0
     
     # Average the losses over valid batches
-    epoch_cost /= valid_batches
-    epoch_cost_cls /= valid_batches
-    epoch_cost_reg /= valid_batches
-    epoch_cost_snip /= valid_batches
+    torch.cuda.synchronize()
+    epoch_cost = epoch_cost.item() / valid_batches
+    epoch_cost_cls = epoch_cost_cls.item() / valid_batches
+    epoch_cost_reg = epoch_cost_reg.item() / valid_batches
+    epoch_cost_snip = epoch_cost_snip.item() / valid_batches
     
     # Final NaN check for epoch averages
     epoch_cost = np.nan_to_num(epoch_cost, nan=0.0, posinf=0.0, neginf=0.0)
@@ -167,7 +190,8 @@ def train_one_epoch(opt, model, train_dataset, optimizer, warmup=False):
     epoch_cost_reg = np.nan_to_num(epoch_cost_reg, nan=0.0, posinf=0.0, neginf=0.0)
     epoch_cost_snip = np.nan_to_num(epoch_cost_snip, nan=0.0, posinf=0.0, neginf=0.0)
     
-    print(f"Processed {valid_batches}/{n_iter+1} valid batches")
+    print(f"Processed {valid_batches}/{n_iter+1} batches with finite inputs and cost, "
+          f"skipped {skipped_steps.item()} updates with invalid gradients")
     
     return n_iter, epoch_cost, epoch_cost_cls, epoch_cost_reg, epoch_cost_snip
 
@@ -183,7 +207,7 @@ def safe_loss_backward(loss, model, optimizer, max_grad_norm=1.0):
             print("Warning: Invalid loss detected, skipping backward pass")
             return False
         
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         
         # Check for NaN gradients
@@ -217,32 +241,39 @@ def train_one_epoch_minimal_fix(opt, model, train_dataset, optimizer, warmup=Fal
     """
     train_loader = torch.utils.data.DataLoader(train_dataset,
                                                 batch_size=opt['batch_size'], shuffle=True,
-                                                num_workers=0, pin_memory=True, drop_last=False)      
-    epoch_cost = 0
-    epoch_cost_cls = 0
-    epoch_cost_reg = 0
-    epoch_cost_snip = 0
+                                                drop_last=False, **loader_kwargs(opt))
+    epoch_cost = torch.zeros((), device='cuda')
+    epoch_cost_cls = torch.zeros((), device='cuda')
+    epoch_cost_reg = torch.zeros((), device='cuda')
+    epoch_cost_snip = torch.zeros((), device='cuda')
     
     total_iter = len(train_dataset) // opt['batch_size']
     cls_loss = MultiCrossEntropyLoss(opt["num_of_class"], focal=True)
     snip_loss = MultiCrossEntropyLoss(opt["num_of_class"], focal=True)
     
     valid_batches = 0
+    alpha, beta, gamma = float(opt['alpha']), float(opt['beta']), float(opt['gamma'])
     
     for n_iter, (input_data, cls_label, reg_label, snip_label) in enumerate(tqdm(train_loader)):
         if warmup:
+            warmup_lr = n_iter * opt['lr'] / total_iter
             for g in optimizer.param_groups:
-                g['lr'] = n_iter * (opt['lr']) / total_iter
+                g['lr'] = warmup_lr
         
-        act_cls, act_reg, snip_cls = model(input_data.float().cuda())
+        cls_label = cls_label.cuda(non_blocking=True)
+        reg_label = reg_label.cuda(non_blocking=True)
+        snip_label = snip_label.cuda(non_blocking=True)
+        act_cls, act_reg, snip_cls = model(input_data.to('cuda', dtype=torch.float32, non_blocking=True))
         
         # Quick NaN check on outputs
         if (torch.isnan(act_cls).any() or torch.isnan(act_reg).any() or torch.isnan(snip_cls).any()):
             print(f"NaN detected in outputs at batch {n_iter}, skipping...")
             continue
         
-        act_cls.register_hook(partial(cls_loss.collect_grad, cls_label))
-        snip_cls.register_hook(partial(snip_loss.collect_grad, snip_label))
+        cls_loss.grad_target = cls_label
+        snip_loss.grad_target = snip_label
+        act_cls.register_hook(cls_loss.grad_hook)
+        snip_cls.register_hook(snip_loss.grad_hook)
         
         cost_reg = 0
         cost_cls = 0
@@ -256,14 +287,14 @@ def train_one_epoch_minimal_fix(opt, model, train_dataset, optimizer, warmup=Fal
         loss = cls_loss_func_(snip_loss, snip_label, snip_cls)
         cost_snip = loss
         
-        cost = opt['alpha'] * cost_cls + opt['beta'] * cost_reg + opt['gamma'] * cost_snip
+        cost = alpha * cost_cls + beta * cost_reg + gamma * cost_snip
         
         # Check total cost for NaN
         if torch.isnan(cost).any():
             print(f"NaN in total cost at batch {n_iter}, skipping...")
             continue
         
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         cost.backward()
         
         # Gradient clipping
@@ -272,14 +303,19 @@ def train_one_epoch_minimal_fix(opt, model, train_dataset, optimizer, warmup=Fal
         optimizer.step()
         
         # Safe accumulation
-        epoch_cost_cls += cost_cls.detach().cpu().numpy()    
-        epoch_cost_reg += cost_reg.detach().cpu().numpy()   
-        epoch_cost_snip += cost_snip.detach().cpu().numpy() 
-        epoch_cost += cost.detach().cpu().numpy()
+        epoch_cost_cls += cost_cls.detach().sum()
+        epoch_cost_reg += cost_reg.detach().sum()
+        epoch_cost_snip += cost_snip.detach().sum()
+        epoch_cost += cost.detach().sum()
         
         valid_batches += 1
     
     # Average over valid batches
+    torch.cuda.synchronize()
+    epoch_cost = epoch_cost.item()
+    epoch_cost_cls = epoch_cost_cls.item()
+    epoch_cost_reg = epoch_cost_reg.item()
+    epoch_cost_snip = epoch_cost_snip.item()
     if valid_batches > 0:
         epoch_cost /= valid_batches
         epoch_cost_cls /= valid_batches
@@ -289,14 +325,43 @@ def train_one_epoch_minimal_fix(opt, model, train_dataset, optimizer, warmup=Fal
     return n_iter, epoch_cost, epoch_cost_cls, epoch_cost_reg, epoch_cost_snip
 
     
+def results_finite(result_dict):
+    """Whether the segments, scores and generation times of all results are finite."""
+    values = [value for proposals in result_dict.values() for proposal in proposals
+              for value in (*proposal["segment"], proposal["score"], proposal["gentime"])]
+    return bool(np.isfinite(np.asarray(values, dtype=np.float64)).all())
+
+def write_result_file(opt, result_dict):
+    """Writes the detection results, with the C serializer from orjson when it is available."""
+    output_dict={"version":"VERSION 1.3","results":result_dict,"external_data":{}}
+    # orjson writes NaN and Infinity as null, which the evaluation can not read
+    # back as numbers; json.dump keeps them as literals.
+    if orjson is not None and results_finite(result_dict):
+        with open(opt["result_file"].format(opt['exp']),"wb") as outfile:
+            outfile.write(orjson.dumps(output_dict, option=orjson.OPT_INDENT_2))
+    else:
+        with open(opt["result_file"].format(opt['exp']),"w") as outfile:
+            json.dump(output_dict,outfile, indent=2)
+
+def save_checkpoint(state, paths):
+    """Writes state to every path from a background thread, which is returned.
+    
+    The tensors are first copied to the host, so training can go on
+    updating the model while the files are written.
+    """
+    state = dict(state, state_dict={k: v.detach().to('cpu', copy=True) for k, v in state['state_dict'].items()})
+    def write():
+        for path in paths:
+            torch.save(state, path, pickle_protocol=5)
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    return thread
+
 def eval_one_epoch(opt, model, test_dataset):
-    cls_loss, reg_loss, tot_loss, output_cls, output_reg, labels_cls, labels_reg, working_time, total_frames = eval_frame(opt, model,test_dataset)
+    cls_loss, reg_loss, tot_loss, output_cls, output_reg, labels_cls, labels_reg, working_time, total_frames = eval_frame(opt, model,test_dataset, sparse=True)
         
     result_dict = eval_map_nms(opt,test_dataset, output_cls, output_reg, labels_cls, labels_reg)
-    output_dict={"version":"VERSION 1.3","results":result_dict,"external_data":{}}
-    outfile=open(opt["result_file"].format(opt['exp']),"w")
-    json.dump(output_dict,outfile, indent=2)
-    outfile.close()
+    write_result_file(opt, result_dict)
     
     IoUmAP = evaluation_detection(opt, verbose=False)
     IoUmAP_5=sum(IoUmAP[0:])/len(IoUmAP[0:])
@@ -305,24 +370,59 @@ def eval_one_epoch(opt, model, test_dataset):
 
     
 def train(opt): 
-    writer = SummaryWriter()
+    # Multi-GPU training when started by torchrun, one process per GPU.
+    distributed = int(os.environ.get('WORLD_SIZE', '1')) > 1
+    if distributed:
+        torch.distributed.init_process_group('nccl')
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+    is_main = not distributed or torch.distributed.get_rank() == 0
+    
+    writer = SummaryWriter() if is_main else None
     model = MYNET(opt).cuda()
     
     rest_of_model_params = [param for name, param in model.named_parameters() if "history_unit" not in name]
   
-    optimizer = optim.Adam([{'params': model.history_unit.parameters(), 'lr': 1e-6}, {'params': rest_of_model_params}],lr=opt["lr"],weight_decay = opt["weight_decay"])  
+    # Fused single-kernel Adam where available (PyTorch >= 2.0), multi-tensor foreach otherwise.
+    if 'fused' in inspect.signature(optim.Adam).parameters:
+        adam_impl = {'fused': True}
+    else:
+        adam_impl = {'foreach': True}
+    optimizer = optim.Adam([{'params': model.history_unit.parameters(), 'lr': 1e-6}, {'params': rest_of_model_params}],lr=opt["lr"],weight_decay = opt["weight_decay"], **adam_impl)
     scheduler = torch.optim.lr_scheduler.StepLR(optimizer,step_size = opt["lr_step"])
     
     train_dataset = VideoDataSet(opt,subset="train")      
     test_dataset = VideoDataSet(opt,subset=opt['inference_subset'])
     
+    # net is the bare model whose state_dict is checkpointed.
+    net = model
+    fast_net = compile_model(opt, net)
+    model = fast_net
+    train_sampler = None
+    if distributed:
+        model = torch.nn.parallel.DistributedDataParallel(fast_net, device_ids=[local_rank], gradient_as_bucket_view=True)
+        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+    
     warmup=False
+    save_thread = None
+    # The forward runs under bf16 autocast where the device supports it.
+    amp = torch.cuda.is_bf16_supported()
+    if not amp:
+        print("Warning: bf16 is not supported on this device, training in float32")
     
     for n_epoch in range(opt['epoch']):   
         if n_epoch >=1:
             warmup=False
+        if train_sampler is not None:
+            train_sampler.set_epoch(n_epoch)
         
-        n_iter, epoch_cost, epoch_cost_cls, epoch_cost_reg, epoch_cost_snip = train_one_epoch(opt, model, train_dataset, optimizer, warmup)
+        n_iter, epoch_cost, epoch_cost_cls, epoch_cost_reg, epoch_cost_snip = train_one_epoch(opt, model, train_dataset, optimizer, warmup, train_sampler, amp)
+        
+        if not is_main:
+            # Only the first process evaluates and writes checkpoints.
+            scheduler.step()
+            torch.distributed.barrier()
+            continue
             
         writer.add_scalars('data/cost', {'train': epoch_cost/(n_iter+1)}, n_epoch)
         print("training loss(epoch %d): %.03f, cls - %f, reg - %f, snip - %f, lr - %f"%(n_epoch,
@@ -333,92 +433,429 @@ def train(opt):
                                                                             optimizer.param_groups[-1]["lr"]) )
         
         scheduler.step()
-        model.eval()
+        net.eval()
         
-        cls_loss, reg_loss, tot_loss, IoUmAP_5 = eval_one_epoch(opt, model,test_dataset)
+        cls_loss, reg_loss, tot_loss, IoUmAP_5 = eval_one_epoch(opt, fast_net,test_dataset)
         
         writer.add_scalars('data/mAP', {'test': IoUmAP_5}, n_epoch)
         print("testing loss(epoch %d): %.03f, cls - %f, reg - %f, mAP Avg - %f"%(n_epoch,tot_loss, cls_loss, reg_loss, IoUmAP_5))
                     
-        state = {'epoch': n_epoch + 1,
-                    'state_dict': model.state_dict()}
-        torch.save(state, opt["checkpoint_path"]+"/"+opt["exp"]+"_checkpoint_"+str(n_epoch+1)+".pth.tar" )
-        if IoUmAP_5 > model.best_map:
-            model.best_map = IoUmAP_5
-            torch.save(state, opt["checkpoint_path"]+"/"+opt["exp"]+"_ckp_best.pth.tar" )
+        # Periodic checkpoints every ckpt_every epochs and at the last one, plus the best.
+        ckpt_paths = []
+        if (n_epoch+1) % opt.get('ckpt_every', 1) == 0 or n_epoch+1 == opt['epoch']:
+            ckpt_paths.append(opt["checkpoint_path"]+"/"+opt["exp"]+"_checkpoint_"+str(n_epoch+1)+".pth.tar")
+        if IoUmAP_5 > net.best_map:
+            net.best_map = IoUmAP_5
+            ckpt_paths.append(opt["checkpoint_path"]+"/"+opt["exp"]+"_ckp_best.pth.tar")
+        if ckpt_paths:
+            if save_thread is not None:
+                save_thread.join()
+            state = {'epoch': n_epoch + 1,
+                        'state_dict': net.state_dict()}
+            save_thread = save_checkpoint(state, ckpt_paths)
             
-        model.train()
-                
-    writer.close()
-    return model.best_map
-
-def eval_frame(opt, model, dataset):
+        net.train()
+        # Hand the irregular evaluation allocations back before the next epoch.
+        torch.cuda.empty_cache()
+        if distributed:
+            torch.distributed.barrier()
+    
+    if save_thread is not None:
+        save_thread.join()
+    if writer is not None:
+        writer.close()
+    if distributed:
+        torch.distributed.destroy_process_group()
+    return net.best_map
+
+@torch.inference_mode()
+def eval_frame(opt, model, dataset, sparse=False):
+    # With sparse=True only the candidates scoring above opt['threshold'] are copied
+    # back: output_cls then maps each video to its Candidates and output_reg is empty.
     test_loader = torch.utils.data.DataLoader(dataset,
                                                 batch_size=opt['batch_size'], shuffle=False,
-                                                num_workers=0, pin_memory=True,drop_last=False)
+                                                drop_last=False, **loader_kwargs(opt))
     
+    # Per video outputs are preallocated and filled in input order through a write cursor.
+    n_anchors = len(opt['anchors'])
+    video_rows = Counter(video_name for video_name, _, _, _ in dataset.inputs)
     labels_cls={}
     labels_reg={}
     output_cls={}
-    output_reg={}                                      
+    output_reg={}
+    cursor={}
     for video_name in dataset.video_list:
-        labels_cls[video_name]=[]
-        labels_reg[video_name]=[]
-        output_cls[video_name]=[]
-        output_reg[video_name]=[]
+        n_rows = video_rows[video_name]
+        labels_cls[video_name]=np.empty((n_rows,)+dataset.cls_label.shape[1:], dtype=np.float32)
+        labels_reg[video_name]=np.empty((n_rows,)+dataset.reg_label.shape[1:], dtype=np.float32)
+        if sparse:
+            output_cls[video_name]=[]
+        else:
+            output_cls[video_name]=np.empty((n_rows, n_anchors, opt['num_of_class']), dtype=np.float32)
+            output_reg[video_name]=np.empty((n_rows, n_anchors, 2), dtype=np.float32)
+        cursor[video_name]=0
+    model = autocast_forward(opt, model)
+    # Pinned staging for the batch outputs, so their device to host copies are truly asynchronous.
+    cls_host = torch.empty((opt['batch_size'], n_anchors, opt['num_of_class']), pin_memory=True)
+    reg_host = torch.empty((opt['batch_size'], n_anchors, 2), pin_memory=True)
         
     start_time = time.time()
     total_frames =0  
-    epoch_cost = 0
-    epoch_cost_cls = 0
-    epoch_cost_reg = 0   
+    epoch_cost = torch.zeros((), device='cuda')
+    epoch_cost_cls = torch.zeros((), device='cuda')
+    epoch_cost_reg = torch.zeros((), device='cuda')
+    alpha, beta = float(opt['alpha']), float(opt['beta'])
     
     for n_iter,(input_data,cls_label,reg_label, _) in enumerate(tqdm(test_loader)):
         # act_cls, act_reg, _ = model(input_data.cuda())
-        act_cls, act_reg, _ = model(input_data.float().cuda())
+        act_cls, act_reg, _ = model(input_data.to('cuda', dtype=torch.float32, non_blocking=True))
         cost_reg = 0
         cost_cls = 0
         
-        loss = cls_loss_func(cls_label,act_cls)
+        # The host labels are kept for the exported outputs, the losses use device copies.
+        loss = cls_loss_func(cls_label.to('cuda', non_blocking=True),act_cls)
         cost_cls = loss
             
-        epoch_cost_cls+= cost_cls.detach().cpu().numpy()    
+        epoch_cost_cls += cost_cls.sum()
                
-        loss = regress_loss_func(reg_label,act_reg)
+        loss = regress_loss_func(reg_label.to('cuda', non_blocking=True),act_reg)
         cost_reg = loss  
-        epoch_cost_reg += cost_reg.detach().cpu().numpy()   
+        epoch_cost_reg += cost_reg.sum()
         
-        cost= opt['alpha']*cost_cls +opt['beta']*cost_reg    
+        cost= alpha*cost_cls +beta*cost_reg    
                 
-        epoch_cost += cost.detach().cpu().numpy() 
+        epoch_cost += cost.sum()
         
         act_cls = torch.softmax(act_cls, dim=-1)
         
         total_frames+=input_data.size(0)
         
-        for b in range(0,input_data.size(0)):
-            video_name, st, ed, data_idx = dataset.inputs[n_iter*opt['batch_size']+b]
-            output_cls[video_name]+=[act_cls[b,:].detach().cpu().numpy()]
-            output_reg[video_name]+=[act_reg[b,:].detach().cpu().numpy()]
-            labels_cls[video_name]+=[cls_label[b,:].numpy()]
-            labels_reg[video_name]+=[reg_label[b,:].numpy()]
+        n_batch = input_data.size(0)
+        if sparse:
+            # The threshold is applied on the device and only the survivors are copied.
+            b_idx, a_idx, c_idx = (act_cls[..., :-1] > opt['threshold']).nonzero(as_tuple=True)
+            picked_idx = torch.stack([b_idx, a_idx, c_idx]).cpu().numpy()
+            picked_val = torch.cat([act_cls[b_idx, a_idx, c_idx].unsqueeze(1), act_reg[b_idx, a_idx]], dim=1).cpu().numpy()
+        else:
+            # One device to host copy per batch, the rows are then copied out of the staging buffers.
+            cls_host[:n_batch].copy_(act_cls, non_blocking=True)
+            reg_host[:n_batch].copy_(act_reg, non_blocking=True)
+            torch.cuda.synchronize()
+            cls_np, reg_np = cls_host[:n_batch].numpy(), reg_host[:n_batch].numpy()
+        cls_label_np, reg_label_np = cls_label.numpy(), reg_label.numpy()
+        
+        # Write every run of consecutive samples of one video as a single slice.
+        batch_inputs = dataset.inputs[n_iter*opt['batch_size']:n_iter*opt['batch_size']+input_data.size(0)]
+        b = 0
+        while b < len(batch_inputs):
+            video_name = batch_inputs[b][0]
+            run_ed = b+1
+            while run_ed < len(batch_inputs) and batch_inputs[run_ed][0] == video_name:
+                run_ed += 1
+            pos = cursor[video_name]
+            rows = slice(pos, pos+run_ed-b)
+            if sparse:
+                # picked_idx is sorted by batch row, so the run's survivors are contiguous.
+                lo, hi = np.searchsorted(picked_idx[0], [b, run_ed])
+                output_cls[video_name].append((picked_idx[:, lo:hi] + np.array([[pos-b], [0], [0]]), picked_val[lo:hi]))
+            else:
+                output_cls[video_name][rows] = cls_np[b:run_ed]
+                output_reg[video_name][rows] = reg_np[b:run_ed]
+            labels_cls[video_name][rows] = cls_label_np[b:run_ed]
+            labels_reg[video_name][rows] = reg_label_np[b:run_ed]
+            cursor[video_name] = pos+run_ed-b
+            b = run_ed
         
     end_time = time.time()
     working_time = end_time-start_time
     
-    for video_name in dataset.video_list:
-        labels_cls[video_name]=np.stack(labels_cls[video_name], axis=0)
-        labels_reg[video_name]=np.stack(labels_reg[video_name], axis=0)
-        output_cls[video_name]=np.stack(output_cls[video_name], axis=0)
-        output_reg[video_name]=np.stack(output_reg[video_name], axis=0)
-    
-    cls_loss=epoch_cost_cls/n_iter
-    reg_loss=epoch_cost_reg/n_iter
-    tot_loss=epoch_cost/n_iter
+    if sparse:
+        for video_name, parts in output_cls.items():
+            idx = np.concatenate([part[0] for part in parts], axis=1) if parts else np.zeros((3, 0), dtype=np.int64)
+            val = np.concatenate([part[1] for part in parts]) if parts else np.zeros((0, 3), dtype=np.float32)
+            output_cls[video_name] = Candidates(idx[0], idx[1], idx[2], val[:, 0], val[:, 1:])
+    
+    cls_loss=epoch_cost_cls.item()/n_iter
+    reg_loss=epoch_cost_reg.item()/n_iter
+    tot_loss=epoch_cost.item()/n_iter
      
     return cls_loss, reg_loss, tot_loss, output_cls, output_reg, labels_cls, labels_reg, working_time, total_frames
 
 
+# (frame, anchor, class) of the detections scoring above the threshold, with
+# their score and their (n x 2) regression.
+Candidates = namedtuple('Candidates', ['frame', 'anchor', 'label', 'score', 'reg'])
+
+
+def _select_candidates_numpy(cls_anc, reg_anc, threshold):
+    t_idx, a_idx, c_idx = np.nonzero(cls_anc[..., :-1] > threshold)
+    return t_idx, a_idx, c_idx, cls_anc[t_idx, a_idx, c_idx], reg_anc[t_idx, a_idx]
+
+
+def _select_candidates_loop(cls_anc, reg_anc, threshold):
+    # Loop version of _select_candidates_numpy, compiled with numba: one pass
+    # counts the candidates, a second fills the preallocated outputs in the
+    # same (frame, anchor, class) order.
+    n_frames, n_anchors, n_cls = cls_anc.shape
+    count = 0
+    for t in range(n_frames):
+        for a in range(n_anchors):
+            for c in range(n_cls-1):
+                if cls_anc[t, a, c] > threshold:
+                    count += 1
+    t_idx = np.empty(count, dtype=np.int64)
+    a_idx = np.empty(count, dtype=np.int64)
+    c_idx = np.empty(count, dtype=np.int64)
+    score = np.empty(count, dtype=cls_anc.dtype)
+    reg = np.empty((count, 2), dtype=reg_anc.dtype)
+    n = 0
+    for t in range(n_frames):
+        for a in range(n_anchors):
+            for c in range(n_cls-1):
+                if cls_anc[t, a, c] > threshold:
+                    t_idx[n] = t
+                    a_idx[n] = a
+                    c_idx[n] = c
+                    score[n] = cls_anc[t, a, c]
+                    reg[n, 0] = reg_anc[t, a, 0]
+                    reg[n, 1] = reg_anc[t, a, 1]
+                    n += 1
+    return t_idx, a_idx, c_idx, score, reg
+
+
+if njit is not None:
+    _select_candidates = njit(cache=True)(_select_candidates_loop)
+else:
+    _select_candidates = _select_candidates_numpy
+
+
+def select_candidates(cls_anc, reg_anc, threshold, frame_offset=0):
+    t_idx, a_idx, c_idx, score, reg = _select_candidates(np.ascontiguousarray(cls_anc), np.ascontiguousarray(reg_anc), threshold)
+    return Candidates(t_idx + frame_offset, a_idx, c_idx, score, reg)
+
+
+def get_proposals(cls_anc, reg_anc, anchors, threshold, frame_scale, label_name, frame_offset=0,
+                  nms_thresh=None, nms_impl="numpy"):
+    """Builds the proposals of all frames, anchors and classes scoring above threshold.
+    
+    cls_anc is (frames x anchors x classes) and reg_anc (frames x anchors x 2),
+    their first frame being frame frame_offset of the video, and frame_scale is
+    the length of a frame in seconds. When nms_thresh is
+    given the proposals are suppressed per class, with torchvision's batched_nms
+    ("torch"), its numpy counterpart interval_nms ("numpy") or the reference
+    non_max_suppression ("python").
+    """
+    candidates = select_candidates(cls_anc, reg_anc, threshold, frame_offset)
+    return candidate_proposals(candidates, anchors, frame_scale, label_name, nms_thresh, nms_impl)
+
+
+def candidate_proposals(candidates, anchors, frame_scale, label_name, nms_thresh=None, nms_impl="numpy"):
+    """Same as get_proposals, for candidates already selected."""
+    return proposal_dicts(candidate_segments(candidates, anchors, frame_scale, nms_thresh, nms_impl), label_name)
+
+
+# Proposals as parallel arrays: segment bounds and generation time in seconds,
+# score and integer class.
+Proposals = namedtuple('Proposals', ['st', 'ed', 'score', 'label', 'gentime'])
+
+
+def candidate_segments(candidates, anchors, frame_scale, nms_thresh=None, nms_impl="numpy"):
+    """Decodes candidates into Proposals, suppressed per class when nms_thresh is given."""
+    frame, a_idx, c_idx, score, reg = candidates
+    anchor = np.asarray(anchors)[a_idx]
+    
+    ed = frame + anchor * reg[:, 0]
+    st = ed - anchor * np.exp(reg[:, 1])
+    st = st*frame_scale
+    ed = ed*frame_scale
+    gentime = frame*frame_scale
+    proposals = Proposals(st, ed, score, c_idx, gentime)
+    
+    if nms_thresh is not None:
+        if nms_impl == "python":
+            # The reference implementation works on dicts, these carry their row.
+            rows = [{"segment": [seg_st, seg_ed], "score": sc, "label": label, "row": row}
+                    for row, (seg_st, seg_ed, sc, label) in enumerate(zip(st.tolist(), ed.tolist(),
+                                                                          score.tolist(), c_idx.tolist()))]
+            kept = non_max_suppression(rows, overlapThresh=nms_thresh)
+            keep = np.asarray([proposal["row"] for proposal in kept], dtype=np.int64)
+        else:
+            nms = batched_interval_nms if nms_impl == "torch" else interval_nms
+            keep = nms(st, ed, score, c_idx, overlapThresh=nms_thresh)
+        proposals = Proposals(*(field[keep] for field in proposals))
+    return proposals
+
+
+def proposal_dicts(proposals, label_name):
+    """Converts Proposals to the dicts written to the result file."""
+    return [{"segment": [seg_st, seg_ed], "score": sc, "label": label_name[label], "gentime": gen}
+            for seg_st, seg_ed, sc, label, gen in zip(proposals.st.tolist(), proposals.ed.tolist(),
+                                                      proposals.score.tolist(), proposals.label.tolist(),
+                                                      proposals.gentime.tolist())]
+
+
+def class_confidence(proposals, n_class):
+    """Score per class of a frame's proposals, the last proposal of a class setting it."""
+    row = np.zeros(n_class, dtype=np.float32)
+    labels, last = np.unique(proposals.label[::-1], return_index=True)
+    row[labels] = proposals.score[::-1][last]
+    return row
+
+
+class SuppressSelection:
+    """Proposals of one video kept by the SuppressNet selection.
+    
+    Frame by frame, in class order, a proposal is kept when SuppressNet
+    confirms its class and it overlaps no kept proposal of that class by more
+    than overlapThresh, the rule of check_overlap_proposal. The kept segments
+    are held per class so the overlap test is one array operation.
+    """
+    def __init__(self, n_class, threshold, overlapThresh=0.3):
+        self.threshold = threshold
+        self.overlapThresh = overlapThresh
+        self.kept_st = [[] for _ in range(n_class)]
+        self.kept_ed = [[] for _ in range(n_class)]
+        self.kept = []
+        
+    def add(self, proposals, suppress_conf):
+        active = np.nonzero(suppress_conf[proposals.label] > self.threshold)[0]
+        active = active[np.argsort(proposals.label[active], kind='stable')]
+        rows = []
+        for row in active.tolist():
+            st, ed, label = proposals.st[row], proposals.ed[row], proposals.label[row]
+            kept_st, kept_ed = self.kept_st[label], self.kept_ed[label]
+            if kept_st:
+                lst = np.maximum(st, kept_st)
+                sed = np.minimum(ed, kept_ed)
+                sst = np.minimum(st, kept_st)
+                led = np.maximum(ed, kept_ed)
+                if np.any((sed-lst) / np.maximum(led-sst, 1) > self.overlapThresh):
+                    continue
+            kept_st.append(st)
+            kept_ed.append(ed)
+            rows.append(row)
+        if rows:
+            self.kept.append(Proposals(*(field[rows] for field in proposals)))
+            
+    def result(self, label_name):
+        """Returns the kept proposals as dicts, in selection order."""
+        if not self.kept:
+            return []
+        return proposal_dicts(Proposals(*(np.concatenate(field) for field in zip(*self.kept))), label_name)
+
+
+class WindowBuffer:
+    """Sliding windows over the last rows of a stream, kept on the device.
+    
+    The buffer holds the last size+batch-1 rows, enough for the windows of
+    `batch` consecutive frames. Every row is written twice, at head and
+    head+capacity, so those rows are always a contiguous view and pushing a
+    row costs O(dim) instead of shifting the whole window.
+    """
+    def __init__(self, size, dim, batch=1, device='cuda'):
+        self.size = size
+        self.dim = dim
+        self.capacity = size + batch - 1
+        self.data = torch.zeros((2*self.capacity, dim), device=device)
+        self.head = 0
+        
+    def reset(self):
+        self.data.zero_()
+        self.head = 0
+        
+    def push(self, rows):
+        """Appends one row or a (n x dim) block of rows, n <= capacity."""
+        rows = rows.reshape(-1, self.dim).to(self.data.device, non_blocking=True)
+        first = min(rows.shape[0], self.capacity - self.head)
+        rest = rows.shape[0] - first
+        self.data[self.head:self.head+first] = rows[:first]
+        self.data[self.head+self.capacity:self.head+self.capacity+first] = rows[:first]
+        if rest > 0:
+            self.data[:rest] = rows[first:]
+            self.data[self.capacity:self.capacity+rest] = rows[first:]
+        self.head = (self.head + rows.shape[0]) % self.capacity
+        
+    def window(self):
+        """Returns the (size x dim) window of the newest row, oldest row first."""
+        end = self.head + self.capacity
+        return self.data[end-self.size:end]
+    
+    def windows(self, n):
+        """Returns the (n x size x dim) windows of the n newest rows."""
+        end = self.head + self.capacity
+        return self.data[end-self.size-n+1:end].unfold(0, self.size, 1).transpose(1, 2)
+
+
+class StagedUpload:
+    """Copies blocks of host rows to the device on a side stream.
+    
+    Blocks go through alternating pinned host and device buffers, so the copy
+    of the next block overlaps the kernels still running on the current stream.
+    """
+    def __init__(self, rows, dim, slots=2):
+        self.stream = torch.cuda.Stream()
+        self.host = [torch.empty((rows, dim), pin_memory=True) for _ in range(slots)]
+        self.device = [torch.empty((rows, dim), device='cuda') for _ in range(slots)]
+        self.done = [None]*slots
+        self.slot = 0
+        
+    def start(self, rows):
+        """Starts copying a (n x dim) block; the returned device rows are valid after wait()."""
+        n = rows.shape[0]
+        slot = self.slot
+        self.slot = (slot+1) % len(self.host)
+        if self.done[slot] is not None:
+            # The previous copy out of this pinned buffer must be finished before overwriting it.
+            self.done[slot].synchronize()
+        self.host[slot][:n].copy_(rows)
+        # Readers of the device buffer on the current stream must also be done.
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.device[slot][:n].copy_(self.host[slot][:n], non_blocking=True)
+            self.done[slot] = torch.cuda.Event()
+            self.done[slot].record()
+        return self.device[slot][:n]
+        
+    def wait(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+
+
+class GraphedForward:
+    """Runs module(inputs) by replaying a CUDA graph captured for one input shape.
+    
+    Inputs of any other shape, e.g. the shorter last chunk of a video, and
+    modules that fail to capture run eagerly. The returned tensors are static
+    and overwritten by the next replay.
+    """
+    def __init__(self, module, shape, pool=None, warmup=3):
+        self.module = module
+        self.graph = None
+        self.static_in = torch.zeros(shape, device='cuda')
+        try:
+            # Warm up on a side stream so the capture sees initialized kernels and allocator state.
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream), torch.no_grad():
+                for _ in range(warmup):
+                    module(self.static_in)
+            torch.cuda.current_stream().wait_stream(stream)
+            
+            graph = torch.cuda.CUDAGraph()
+            with torch.no_grad(), torch.cuda.graph(graph, pool=pool):
+                self.static_out = module(self.static_in)
+            self.graph = graph
+        except RuntimeError as e:
+            print("CUDA graph capture failed, running eagerly: {}".format(e))
+            
+    def __call__(self, inputs):
+        if self.graph is None or inputs.shape != self.static_in.shape:
+            with torch.no_grad():
+                return self.module(inputs)
+        self.static_in.copy_(inputs, non_blocking=True)
+        self.graph.replay()
+        return self.static_out
+
+
 def eval_map_nms(opt, dataset, output_cls, output_reg, labels_cls, labels_reg):
     result_dict={}
     proposal_dict=[]
@@ -426,40 +863,20 @@ def eval_map_nms(opt, dataset, output_cls, output_reg, labels_cls, labels_reg):
     num_class = opt["num_of_class"]
     unit_size = opt['segment_size']
     threshold=opt['threshold']
-    anchors=opt['anchors']
+    anchors=np.asarray(opt['anchors'])
                                              
     for video_name in dataset.video_list:
         duration = dataset.video_len[video_name]
         video_time = float(dataset.video_dict[video_name]["duration"])
-        frame_to_time = 100.0*video_time / duration
+        frame_scale = video_time / duration
          
-        for idx in range(0,duration):
-            cls_anc = output_cls[video_name][idx]
-            reg_anc = output_reg[video_name][idx]
-            
-            proposal_anc_dict=[]
-            for anc_idx in range(0,len(anchors)):
-                cls = np.argwhere(cls_anc[anc_idx][:-1]>opt['threshold']).reshape(-1)
-                
-                if len(cls) == 0:
-                    continue
-                    
-                ed= idx + anchors[anc_idx] * reg_anc[anc_idx][0]
-                length = anchors[anc_idx]* np.exp(reg_anc[anc_idx][1])
-                st= ed-length
-                
-                for cidx in range(0,len(cls)):
-                    label=cls[cidx]
-                    tmp_dict={}
-                    tmp_dict["segment"] = [float(st*frame_to_time/100.0), float(ed*frame_to_time/100.0)]
-                    tmp_dict["score"]= float(cls_anc[anc_idx][label])  # Convert to Python float
-                    tmp_dict["label"]=dataset.label_name[label]
-                    tmp_dict["gentime"]= float(idx*frame_to_time/100.0)
-                    proposal_anc_dict.append(tmp_dict)
-                
-            proposal_dict+=proposal_anc_dict
-        
-        proposal_dict=non_max_suppression(proposal_dict, overlapThresh=opt['soft_nms'])
+        if isinstance(output_cls[video_name], Candidates):
+            proposal_dict = candidate_proposals(output_cls[video_name], anchors, frame_scale, dataset.label_name,
+                                                nms_thresh=opt['soft_nms'], nms_impl=opt.get('nms_impl', 'numpy'))
+        else:
+            proposal_dict = get_proposals(output_cls[video_name], output_reg[video_name], anchors,
+                                          opt['threshold'], frame_scale, dataset.label_name,
+                                          nms_thresh=opt['soft_nms'], nms_impl=opt.get('nms_impl', 'numpy'))
                     
         result_dict[video_name]=proposal_dict
         proposal_dict=[]
@@ -467,72 +884,69 @@ def eval_map_nms(opt, dataset, output_cls, output_reg, labels_cls, labels_reg):
     return result_dict
 
 
+_SUP_MODEL_CACHE = {}
+
+def load_suppress_net(opt):
+    """Loads the best SuppressNet, returning it with the device its inputs go to.
+    
+    With opt['quantize_sup'] the Linear layers are dynamically quantized to
+    int8 and the model runs on the CPU, where its inputs are built. Models are
+    loaded once per checkpoint and reused by later calls.
+    """
+    device = 'cpu' if opt.get('quantize_sup') else 'cuda'
+    path = opt["checkpoint_path"]+"/ckp_best_suppress.pth.tar"
+    key = (path, device)
+    if key not in _SUP_MODEL_CACHE:
+        model = SuppressNet(opt).to(device)
+        load_kwargs = {'weights_only': True} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+        checkpoint = torch.load(path, map_location=device, **load_kwargs)
+        base_dict=checkpoint['state_dict']
+        model.load_state_dict(base_dict)
+        model.eval()
+        if opt.get('quantize_sup'):
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        _SUP_MODEL_CACHE[key] = model
+    return _SUP_MODEL_CACHE[key], device
+
+@torch.inference_mode()
 def eval_map_supnet(opt, dataset, output_cls, output_reg, labels_cls, labels_reg):
-    model = SuppressNet(opt).cuda()
-    checkpoint = torch.load(opt["checkpoint_path"]+"/ckp_best_suppress.pth.tar")
-    base_dict=checkpoint['state_dict']
-    model.load_state_dict(base_dict)
-    model.eval()
+    model, sup_device = load_suppress_net(opt)
+    if sup_device == 'cuda':
+        model = autocast_forward(opt, compile_model(opt, model, mode='reduce-overhead'))
     
     result_dict={}
-    proposal_dict=[]
     
     num_class = opt["num_of_class"]
     unit_size = opt['segment_size']
     threshold=opt['threshold']
-    anchors=opt['anchors']
+    anchors=np.asarray(opt['anchors'])
+    conf_queue = WindowBuffer(unit_size, num_class-1, device=sup_device)
+    # Each frame only has a handful of candidates, so they are suppressed on
+    # the CPU; the torchvision path would sync with the device every frame.
+    nms_impl = 'python' if opt.get('nms_impl') == 'python' else 'numpy'
                                              
     for video_name in dataset.video_list:
         duration = dataset.video_len[video_name]
         video_time = float(dataset.video_dict[video_name]["duration"])
-        frame_to_time = 100.0*video_time / duration
-        conf_queue = torch.zeros((unit_size,num_class-1)) 
+        frame_scale = video_time / duration
+        conf_queue.reset()
+        selection = SuppressSelection(num_class-1, opt['sup_threshold'], overlapThresh=opt['soft_nms'])
         
         for idx in range(0,duration):
             cls_anc = output_cls[video_name][idx]
             reg_anc = output_reg[video_name][idx]
             
-            proposal_anc_dict=[]
-            for anc_idx in range(0,len(anchors)):
-                cls = np.argwhere(cls_anc[anc_idx][:-1]>opt['threshold']).reshape(-1)
-                
-                if len(cls) == 0:
-                    continue
-                    
-                ed= idx + anchors[anc_idx] * reg_anc[anc_idx][0]
-                length = anchors[anc_idx]* np.exp(reg_anc[anc_idx][1])
-                st= ed-length
-                
-                for cidx in range(0,len(cls)):
-                    label=cls[cidx]
-                    tmp_dict={}
-                    tmp_dict["segment"] = [float(st*frame_to_time/100.0), float(ed*frame_to_time/100.0)]
-                    tmp_dict["score"]= float(cls_anc[anc_idx][label])  # Convert to Python float
-                    tmp_dict["label"]=dataset.label_name[label]
-                    tmp_dict["gentime"]= float(idx*frame_to_time/100.0)
-                    proposal_anc_dict.append(tmp_dict)
-                          
-            proposal_anc_dict = non_max_suppression(proposal_anc_dict, overlapThresh=opt['soft_nms'])  
-                
-            conf_queue[:-1,:]=conf_queue[1:,:].clone()
-            conf_queue[-1,:]=0
-            for proposal in proposal_anc_dict:
-                cls_idx = dataset.label_name.index(proposal['label'])
-                conf_queue[-1,cls_idx]=proposal["score"]
-            
-            minput = conf_queue.unsqueeze(0)
-            suppress_conf = model(minput.cuda())
-            suppress_conf=suppress_conf.squeeze(0).detach().cpu().numpy()
+            candidates = select_candidates(cls_anc[None], reg_anc[None], opt['threshold'], frame_offset=idx)
+            proposals = candidate_segments(candidates, anchors, frame_scale,
+                                           nms_thresh=opt['soft_nms'], nms_impl=nms_impl)
+            conf_queue.push(torch.from_numpy(class_confidence(proposals, num_class-1)))
             
-            for cls in range(0,num_class-1):
-                if suppress_conf[cls] > opt['sup_threshold']:
-                    for proposal in proposal_anc_dict:
-                        if proposal['label'] == dataset.label_name[cls]:
-                            if check_overlap_proposal(proposal_dict, proposal, overlapThresh=opt['soft_nms']) is None:
-                                proposal_dict.append(proposal)
+            minput = conf_queue.window().unsqueeze(0)
+            suppress_conf = model(minput)
+            suppress_conf=suppress_conf.squeeze(0).cpu().numpy()
+            selection.add(proposals, suppress_conf)
             
-        result_dict[video_name]=proposal_dict
-        proposal_dict=[]
+        result_dict[video_name]=selection.result(dataset.label_name)
         
     return result_dict
 
@@ -543,28 +957,22 @@ def test_frame(opt):
     base_dict=checkpoint['state_dict']
     model.load_state_dict(base_dict)
     model.eval()
+    model = compile_model(opt, model, mode='reduce-overhead')
     
     dataset = VideoDataSet(opt,subset=opt['inference_subset'])    
-    outfile = h5py.File(opt['frame_result_file'].format(opt['exp']), 'w')
+    outfile = h5py.File(opt['frame_result_file'].format(opt['exp']), 'w', libver='latest', rdcc_nbytes=64*1024*1024)
     
     cls_loss, reg_loss, tot_loss, output_cls, output_reg, labels_cls, labels_reg, working_time, total_frames = eval_frame(opt, model,dataset)
     
     print("testing loss: %f, cls_loss: %f, reg_loss: %f"%(tot_loss, cls_loss, reg_loss ))
     
     for video_name in dataset.video_list:
-        o_cls=output_cls[video_name]
-        o_reg=output_reg[video_name]
-        l_cls=labels_cls[video_name]
-        l_reg=labels_reg[video_name]
-        
-        dset_predcls = outfile.create_dataset(video_name+'/pred_cls', o_cls.shape, maxshape=o_cls.shape, chunks=True, dtype=np.float32)
-        dset_predcls[:,:] = o_cls[:,:]  
-        dset_predreg = outfile.create_dataset(video_name+'/pred_reg', o_reg.shape, maxshape=o_reg.shape, chunks=True, dtype=np.float32)
-        dset_predreg[:,:] = o_reg[:,:]   
-        dset_labelcls = outfile.create_dataset(video_name+'/label_cls', l_cls.shape, maxshape=l_cls.shape, chunks=True, dtype=np.float32)
-        dset_labelcls[:,:] = l_cls[:,:]   
-        dset_labelreg = outfile.create_dataset(video_name+'/label_reg', l_reg.shape, maxshape=l_reg.shape, chunks=True, dtype=np.float32)
-        dset_labelreg[:,:] = l_reg[:,:]   
+        fields = {'pred_cls': output_cls[video_name], 'pred_reg': output_reg[video_name],
+                  'label_cls': labels_cls[video_name], 'label_reg': labels_reg[video_name]}
+        # Written in one call, chunked along time in blocks of up to 256 frames.
+        for field, data in fields.items():
+            outfile.create_dataset(video_name+'/'+field, data=data, dtype=np.float32,
+                                   chunks=(min(256, data.shape[0]),)+data.shape[1:])
     outfile.close()
                     
     print("working time : {}s, {}fps, {} frames".format(working_time, total_frames/working_time, total_frames))
@@ -597,24 +1005,23 @@ def test(opt):
     base_dict=checkpoint['state_dict']
     model.load_state_dict(base_dict)
     model.eval()
+    model = compile_model(opt, model, mode='reduce-overhead')
     
     dataset = VideoDataSet(opt,subset=opt['inference_subset'])
     
-    cls_loss, reg_loss, tot_loss, output_cls, output_reg, labels_cls, labels_reg, working_time, total_frames = eval_frame(opt, model,dataset)
+    cls_loss, reg_loss, tot_loss, output_cls, output_reg, labels_cls, labels_reg, working_time, total_frames = eval_frame(opt, model,dataset, sparse=opt["pptype"]=="nms")
     
 
     if opt["pptype"]=="nms":
         result_dict = eval_map_nms(opt,dataset, output_cls, output_reg, labels_cls, labels_reg)
     if opt["pptype"]=="net":
         result_dict = eval_map_supnet(opt,dataset, output_cls, output_reg, labels_cls, labels_reg)
-    output_dict={"version":"VERSION 1.3","results":result_dict,"external_data":{}}
-    outfile=open(opt["result_file"].format(opt['exp']),"w")
-    json.dump(output_dict,outfile, indent=2)
-    outfile.close()
+    write_result_file(opt, result_dict)
     
-    mAP = evaluation_detection(opt)
+    mAP = evaluation_detection(opt, n_jobs=-1)
 
 
+@torch.inference_mode()
 def test_online(opt): 
     model = MYNET(opt).cuda()
     checkpoint = torch.load(opt["checkpoint_path"]+"/ckp_best.pth.tar")
@@ -622,105 +1029,111 @@ def test_online(opt):
     model.load_state_dict(base_dict)
     model.eval()
     
-    sup_model = SuppressNet(opt).cuda()
-    checkpoint = torch.load(opt["checkpoint_path"]+"/ckp_best_suppress.pth.tar")
-    base_dict=checkpoint['state_dict']
-    sup_model.load_state_dict(base_dict)
-    sup_model.eval()
+    sup_model, sup_device = load_suppress_net(opt)
     
     dataset = VideoDataSet(opt,subset=opt['inference_subset'])
-    test_loader = torch.utils.data.DataLoader(dataset,
-                                                batch_size=1, shuffle=False,
-                                                num_workers=0, pin_memory=True,drop_last=False)
     
     result_dict={}
-    proposal_dict=[]
     
     
     num_class = opt["num_of_class"]
     unit_size = opt['segment_size']
     threshold=opt['threshold']
-    anchors=opt['anchors']
+    anchors=np.asarray(opt['anchors'])
+    
+    # Consecutive frames are forwarded together; the windows only depend on
+    # the input stream, so the results match frame-by-frame inference.
+    online_batch = opt.get('online_batch', 16)
+    # Per-frame suppression stays on the CPU, as in eval_map_supnet.
+    nms_impl = 'python' if opt.get('nms_impl') == 'python' else 'numpy'
+    input_queue = WindowBuffer(unit_size, opt['feat_dim'], batch=online_batch)
+    sup_queue = WindowBuffer(unit_size, num_class-1, batch=online_batch, device=sup_device)
+    
+    # Full chunks have a fixed shape, so their forwards are replayed as CUDA graphs
+    # sharing one memory pool. Compiled models are captured with Inductor's own
+    # graphs disabled, so its fused kernels end up in the replayed graphs.
+    model = autocast_forward(opt, compile_model(opt, model, mode='default'))
+    if sup_device == 'cuda':
+        sup_model = autocast_forward(opt, compile_model(opt, sup_model, mode='default'))
+    if not opt.get('no_cuda_graph', False):
+        pool = torch.cuda.graph_pool_handle()
+        model_forward = GraphedForward(model, (online_batch, unit_size, opt['feat_dim']), pool=pool)
+    else:
+        model_forward = model
+    if not opt.get('no_cuda_graph', False) and sup_device == 'cuda':
+        sup_forward = GraphedForward(sup_model, (online_batch, unit_size, num_class-1), pool=pool)
+    else:
+        sup_forward = sup_model
+    
+    # The features of the next chunk are read and uploaded while the model
+    # runs on the current one.
+    input_upload = StagedUpload(online_batch, opt['feat_dim'])
     
     start_time = time.time()
     total_frames =0 
     
     
     for video_name in dataset.video_list:
-        input_queue = torch.zeros((unit_size,opt['feat_dim'])) 
-        sup_queue = torch.zeros(((unit_size,num_class-1)))
+        input_queue.reset()
+        sup_queue.reset()
     
         duration = dataset.video_len[video_name]
         video_time = float(dataset.video_dict[video_name]["duration"])
-        frame_to_time = 100.0*video_time / duration
+        frame_scale = video_time / duration
+        video_feats = dataset._get_video_features(video_name)
+        selection = SuppressSelection(num_class-1, opt['sup_threshold'], overlapThresh=opt['soft_nms'])
+        next_input = input_upload.start(video_feats[0:min(online_batch, duration)])
         
-        for idx in range(0,duration):
-            total_frames+=1
-            input_queue[:-1,:]=input_queue[1:,:].clone()
-            input_queue[-1:,:]=dataset._get_base_data(video_name,idx,idx+1)
+        for chunk_st in range(0,duration,online_batch):
+            chunk_ed = min(chunk_st+online_batch, duration)
+            n_frames = chunk_ed-chunk_st
+            total_frames+=n_frames
+            input_upload.wait()
+            input_queue.push(next_input)
             
-            minput = input_queue.unsqueeze(0)
-            act_cls, act_reg, _ = model(minput.cuda())
+            minput = input_queue.windows(n_frames).contiguous()
+            act_cls, act_reg, _ = model_forward(minput)
             act_cls = torch.softmax(act_cls, dim=-1)
+            if chunk_ed < duration:
+                next_input = input_upload.start(video_feats[chunk_ed:min(chunk_ed+online_batch, duration)])
             
-            cls_anc = act_cls.squeeze(0).detach().cpu().numpy()
-            reg_anc = act_reg.squeeze(0).detach().cpu().numpy()
+            cls_chunk = act_cls.cpu().numpy()
+            reg_chunk = act_reg.cpu().numpy()
             
-            proposal_anc_dict=[]
-            for anc_idx in range(0,len(anchors)):
-                cls = np.argwhere(cls_anc[anc_idx][:-1]>opt['threshold']).reshape(-1)
-                
-                if len(cls) == 0:
-                    continue
-                    
-                ed= idx + anchors[anc_idx] * reg_anc[anc_idx][0]
-                length = anchors[anc_idx]* np.exp(reg_anc[anc_idx][1])
-                st= ed-length
-                
-                for cidx in range(0,len(cls)):
-                    label=cls[cidx]
-                    tmp_dict={}
-                    tmp_dict["segment"] = [float(st*frame_to_time/100.0), float(ed*frame_to_time/100.0)]
-                    tmp_dict["score"]= float(cls_anc[anc_idx][label])  # Convert to Python float
-                    tmp_dict["label"]=dataset.label_name[label]
-                    tmp_dict["gentime"]= float(idx*frame_to_time/100.0)
-                    proposal_anc_dict.append(tmp_dict)
-                          
-            proposal_anc_dict = non_max_suppression(proposal_anc_dict, overlapThresh=opt['soft_nms'])  
-                
-            sup_queue[:-1,:]=sup_queue[1:,:].clone()
-            sup_queue[-1,:]=0
-            for proposal in proposal_anc_dict:
-                cls_idx = dataset.label_name.index(proposal['label'])
-                sup_queue[-1,cls_idx]=proposal["score"]
+            chunk_proposals = []
+            sup_rows = np.zeros((n_frames, num_class-1), dtype=np.float32)
+            for j in range(0,n_frames):
+                candidates = select_candidates(cls_chunk[j][None], reg_chunk[j][None], opt['threshold'], frame_offset=chunk_st+j)
+                proposals = candidate_segments(candidates, anchors, frame_scale,
+                                               nms_thresh=opt['soft_nms'], nms_impl=nms_impl)
+                sup_rows[j] = class_confidence(proposals, num_class-1)
+                chunk_proposals.append(proposals)
+            sup_queue.push(torch.from_numpy(sup_rows))
             
-            minput = sup_queue.unsqueeze(0)
-            suppress_conf = sup_model(minput.cuda())
-            suppress_conf=suppress_conf.squeeze(0).detach().cpu().numpy()
+            minput = sup_queue.windows(n_frames).contiguous()
+            suppress_chunk = sup_forward(minput).cpu().numpy()
             
-            for cls in range(0,num_class-1):
-                if suppress_conf[cls] > opt['sup_threshold']:
-                    for proposal in proposal_anc_dict:
-                        if proposal['label'] == dataset.label_name[cls]:
-                            if check_overlap_proposal(proposal_dict, proposal, overlapThresh=opt['soft_nms']) is None:
-                                proposal_dict.append(proposal)
+            for suppress_conf, proposals in zip(suppress_chunk, chunk_proposals):
+                selection.add(proposals, suppress_conf)
             
-        result_dict[video_name]=proposal_dict
-        proposal_dict=[]
+        result_dict[video_name]=selection.result(dataset.label_name)
     
     end_time = time.time()
     working_time = end_time-start_time
     print("working time : {}s, {}fps, {} frames".format(working_time, total_frames/working_time, total_frames))
     
-    output_dict={"version":"VERSION 1.3","results":result_dict,"external_data":{}}
-    outfile=open(opt["result_file"].format(opt['exp']),"w")
-    json.dump(output_dict,outfile, indent=2)
-    outfile.close()
+    write_result_file(opt, result_dict)
     
-    evaluation_detection(opt)
+    evaluation_detection(opt, n_jobs=-1)
 
 
 def main(opt):
+    # Must be set before the first CUDA allocation; an explicit environment
+    # setting takes precedence.
+    if opt.get('cuda_alloc_conf'):
+        os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', opt['cuda_alloc_conf'])
+    # cuDNN autotuning picks kernels nondeterministically, so seeded runs keep the heuristics.
+    torch.backends.cudnn.benchmark = opt['seed'] < 0
     max_perf=0
     if opt['mode'] == 'train':
         max_perf=train(opt)
@@ -731,7 +1144,7 @@ def main(opt):
     if opt['mode'] == 'test_online':
         test_online(opt)
     if opt['mode'] == 'eval':
-        evaluation_detection(opt)
+        evaluation_detection(opt, n_jobs=-1)
         
     return max_perf
 
@@ -753,8 +1166,9 @@ if __name__ == '__main__':
     opt['anchors'] = [int(item) for item in opt['anchors'].split(',')]  
            
     main(opt)
-    while(opt['wterm']):
-        pass
+    if opt['wterm']:
+        # Keep the process alive without spinning a core.
+        threading.Event().wait()
 
 
 
@@ -124,6 +124,26 @@ def parse_opt():
         '--lr_step',
         type=int,
         default=3)
+    parser.add_argument(
+        '--ckpt_every',
+        type=int,
+        default=1,
+        help='epochs between periodic checkpoints; the best and the last epoch are always saved')
+    parser.add_argument(
+        '--accum_steps',
+        type=int,
+        default=1,
+        help='batches whose gradients are accumulated before each optimizer step')
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=4,
+        help='DataLoader worker processes, 0 loads batches in the main process')
+    parser.add_argument(
+        '--prefetch_factor',
+        type=int,
+        default=2,
+        help='batches loaded in advance by each DataLoader worker')
         
     # Post processing
     parser.add_argument(
@@ -162,6 +182,49 @@ def parse_opt():
         '--soft_nms',
         type=float,
         default=0.3)
+    parser.add_argument(
+        '--nms_impl',
+        type=str,
+        default="numpy",
+        help='numpy: interval_nms, python: reference non_max_suppression, torch: torchvision batched_nms (opt-in, '
+             'may differ from the reference on sub-second segments)')
+    parser.add_argument(
+        '--online_batch',
+        type=int,
+        default=16,
+        help='consecutive frames forwarded together in test_online')
+    parser.add_argument(
+        '--no_cuda_graph',
+        default=False,
+        action='store_true',
+        help='run the test_online forwards eagerly instead of replaying CUDA graphs')
+    parser.add_argument(
+        '--compile',
+        default=False,
+        action='store_true',
+        help='compile MYNET and SuppressNet with torch.compile')
+    parser.add_argument(
+        '--compile_mode',
+        type=str,
+        default=None,
+        help='torch.compile mode overriding the per path defaults (max-autotune for training, reduce-overhead for inference)')
+    parser.add_argument(
+        '--quantize_sup',
+        default=False,
+        action='store_true',
+        help='run SuppressNet int8 dynamically quantized on the CPU')
+    parser.add_argument(
+        '--amp_inference',
+        default=False,
+        action='store_true',
+        help='run the inference forwards under bf16 autocast')
+    parser.add_argument(
+        '--cuda_alloc_conf',
+        type=str,
+        default='',
+        help='opt-in PYTORCH_CUDA_ALLOC_CONF, used unless already set in the environment, '
+             'e.g. expandable_segments:True,garbage_collection_threshold:0.8; '
+             'applies to the CUDA graph pools as well')
     parser.add_argument(
         '--video_len_file',
         type=str,
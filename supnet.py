@@ -29,7 +29,7 @@ def train_one_epoch(opt, model, train_dataset, optimizer):
         loss = suppress_loss_func(label,suppress_conf)
         epoch_cost+= loss.detach().cpu().numpy()    
                
-        optimizer.zero_grad()
+        optimizer.zero_grad(set_to_none=True)
         loss.backward()
         optimizer.step()   
                 
@@ -0,0 +1,67 @@
+import math
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+if not torch.cuda.is_available():
+    pytest.skip("train_one_epoch runs on CUDA", allow_module_level=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+main = pytest.importorskip("main")
+
+N_CLASS = 4
+FEAT_DIM = 8
+
+
+class TinyNet(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.cls = torch.nn.Linear(FEAT_DIM, N_CLASS)
+        self.reg = torch.nn.Linear(FEAT_DIM, 2)
+        self.snip = torch.nn.Linear(FEAT_DIM, N_CLASS)
+
+    def forward(self, x):
+        return self.cls(x), self.reg(x), self.snip(x)
+
+
+def make_dataset(n_batches, nan_batch):
+    generator = torch.Generator().manual_seed(0)
+    samples = []
+    for idx in range(n_batches):
+        feats = torch.randn(FEAT_DIM, generator=generator)
+        if idx == nan_batch:
+            feats[0] = float('nan')
+        label = torch.zeros(N_CLASS)
+        label[idx % N_CLASS] = 1
+        samples.append((feats, label, torch.randn(2, generator=generator), label.clone()))
+    return samples
+
+
+@pytest.mark.parametrize("adam_impl", [{'foreach': True}, {'fused': True}])
+def test_nan_batch_on_update_step_skips_only_its_window(adam_impl):
+    torch.manual_seed(0)
+    model = TinyNet().cuda()
+    initial = [param.detach().clone() for param in model.parameters()]
+    try:
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-2, **adam_impl)
+    except TypeError:
+        pytest.skip("Adam implementation not available")
+    opt = {'batch_size': 1, 'accum_steps': 2, 'num_workers': 0, 'lr': 1e-2,
+           'alpha': 1, 'beta': 1, 'gamma': 1, 'num_of_class': N_CLASS}
+    # Batch 1 closes the first accumulation window.
+    dataset = make_dataset(4, nan_batch=1)
+
+    n_iter, epoch_cost, _, _, _ = main.train_one_epoch(
+        opt, model, dataset, optimizer, sampler=torch.utils.data.SequentialSampler(dataset), amp=False)
+
+    assert n_iter == 3
+    assert math.isfinite(epoch_cost) and epoch_cost > 0
+    for param, before in zip(model.parameters(), initial):
+        # The gradients of the bad window were dropped, not carried over.
+        assert param.grad is None
+        assert torch.isfinite(param).all()
+        assert not torch.equal(param, before)
+        # Only the second window was applied.
+        assert int(optimizer.state[param]['step']) == 1